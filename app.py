@@ -1,10 +1,9 @@
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from typing import List, Dict, Any
-import json
-import uuid
-from datetime import datetime
+from typing import Dict, Any, Optional
 from sheets_service import SheetsService
+from connection_manager import ConnectionManager
+from message_codec import MessageError, decode_frame, new_message
 import os
 from dotenv import load_dotenv
 
@@ -22,32 +21,30 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# WebSocket connection manager
-class ConnectionManager:
-    def __init__(self):
-        self.active_connections: Dict[str, List[WebSocket]] = {}
+def sheet_record(message):
+    """The message row as stored in the sheet, with an ISO timestamp"""
+    return dict(message.record, timestamp=message.record["timestamp"].isoformat())
 
-    async def connect(self, websocket: WebSocket, group_name: str):
-        await websocket.accept()
-        if group_name not in self.active_connections:
-            self.active_connections[group_name] = []
-        self.active_connections[group_name].append(websocket)
+async def message_history(group_name: str, last_id: str, limit: int):
+    return await sheets_service.aget_messages_after(group_name, last_id, limit)
 
-    def disconnect(self, websocket: WebSocket, group_name: str):
-        if group_name in self.active_connections:
-            self.active_connections[group_name].remove(websocket)
+# WebSocket connection manager; reconnecting clients catch up from the Messages mirror
+manager = ConnectionManager(history=message_history)
 
-    async def broadcast(self, message: str, group_name: str):
-        if group_name in self.active_connections:
-            for connection in self.active_connections[group_name]:
-                await connection.send_text(message)
+@app.on_event("startup")
+async def startup_event():
+    # Sheets writes are batched off the event loop
+    await sheets_service.writer.start()
 
-manager = ConnectionManager()
+@app.on_event("shutdown")
+async def shutdown_event():
+    await sheets_service.writer.stop()
+    sheets_service.close()
 
 @app.post("/submit_questionnaire/")
 async def submit_questionnaire(data: Dict[str, Any]):
     try:
-        sheets_service.save_questionnaire(data)
+        await sheets_service.queue_questionnaire(data)
         return {"status": "success", "message": "Questionnaire submitted successfully"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -63,44 +60,45 @@ async def get_groups():
 @app.get("/messages/{group_name}")
 async def get_messages(group_name: str):
     try:
-        messages = sheets_service.get_messages(group_name)
+        messages = await sheets_service.aget_messages(group_name)
         return messages
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/cache_stats/")
+async def cache_stats():
+    return sheets_service.cache.stats()
+
 @app.post("/send_message/")
 async def send_message(data: Dict[str, Any]):
     try:
-        message_id = str(uuid.uuid4())
-        timestamp = datetime.now().isoformat()
-        
-        message_data = {
-            "id": message_id,
-            "group_name": data["group_name"],
-            "email": data["email"],
-            "message": data["message"],
-            "timestamp": timestamp
-        }
-        
-        sheets_service.save_message(message_data)
-        await manager.broadcast(json.dumps(message_data), data["group_name"])
+        message = new_message(data["group_name"], data.get("email"), data.get("message"))
+        await sheets_service.queue_message(sheet_record(message))
+        await manager.broadcast(message.payload, data["group_name"], message.record["id"])
         return {"status": "success", "message": "Message sent successfully"}
+    except MessageError as e:
+        raise HTTPException(status_code=422, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.websocket("/ws/{group_name}")
-async def websocket_endpoint(websocket: WebSocket, group_name: str):
-    await manager.connect(websocket, group_name)
+async def websocket_endpoint(websocket: WebSocket, group_name: str, last_id: Optional[str] = None):
+    # last_id: the last message a reconnecting client saw; everything after it is replayed first
+    await manager.connect(websocket, group_name, last_id)
     try:
         while True:
             data = await websocket.receive_text()
-            message_data = json.loads(data)
-            message_data["id"] = str(uuid.uuid4())
-            message_data["timestamp"] = datetime.now().isoformat()
-            
-            sheets_service.save_message(message_data)
-            await manager.broadcast(json.dumps(message_data), group_name)
+            try:
+                message = decode_frame(data, group_name)
+            except MessageError as e:
+                print(f"Dropping invalid message for {group_name}: {str(e)}")
+                continue
+            await sheets_service.queue_message(sheet_record(message))
+            await manager.broadcast(message.payload, group_name, message.record["id"])
     except WebSocketDisconnect:
+        pass
+    finally:
+        # Whatever ended the loop, the socket must leave its group
         manager.disconnect(websocket, group_name)
 
 if __name__ == "__main__":
@@ -0,0 +1,192 @@
+"""Drive concurrent WebSocket clients against main:app in process and measure fan-out.
+
+    python bench/chat_fanout.py [--groups 10] [--clients-per-group 10] [--messages 50]
+                                [--interval-ms 0] [--database-url URL | --no-db] [--output chat.json]
+
+Every client sends --messages messages to its group and receives everything
+sent to the group, itself included. Clients talk to the ASGI app directly,
+without sockets or threads, so the numbers measure the app: the handler, the
+codec, ConnectionManager fan-out, the broadcast backend and the write-behind
+queue.
+
+The database is --database-url, else $DATABASE_URL, else a throwaway
+Postgres started with the pgserver package when it is installed. database.py
+relies on Postgres features (unnest, advisory locks, ADD COLUMN IF NOT
+EXISTS), so SQLite cannot stand in for it. --no-db skips persistence and
+measures fan-out alone.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+from common import peak_rss_mb, write_report
+
+
+class ASGIWebSocket:
+    """A WebSocket client that calls an ASGI app directly"""
+
+    def __init__(self, app, path: str):
+        self.app = app
+        self.scope = {
+            'type': 'websocket', 'asgi': {'version': '3.0'}, 'scheme': 'ws', 'http_version': '1.1',
+            'path': path, 'raw_path': path.encode(), 'root_path': '', 'query_string': b'',
+            'headers': [(b'host', b'bench')], 'client': ('127.0.0.1', 0), 'server': ('bench', 80),
+            'subprotocols': [],
+        }
+        self.inbound: asyncio.Queue = asyncio.Queue()
+        self.outbound: asyncio.Queue = asyncio.Queue()
+        self.task = None
+
+    async def connect(self):
+        self.task = asyncio.create_task(self.app(self.scope, self.inbound.get, self.outbound.put))
+        await self.inbound.put({'type': 'websocket.connect'})
+        message = await self.outbound.get()
+        if message['type'] != 'websocket.accept':
+            raise RuntimeError(f"Connection refused: {message}")
+
+    async def send_text(self, text: str):
+        await self.inbound.put({'type': 'websocket.receive', 'text': text})
+
+    async def receive(self) -> dict:
+        return await self.outbound.get()
+
+    async def close(self):
+        await self.inbound.put({'type': 'websocket.disconnect', 'code': 1000})
+        await self.task
+
+
+def resolve_database_url(args, workdir):
+    if args.no_db:
+        return None, 'none'
+    if args.database_url or os.getenv('DATABASE_URL'):
+        return args.database_url or os.getenv('DATABASE_URL'), 'postgres'
+    try:
+        import pgserver
+    except ImportError:
+        sys.exit("Set --database-url or DATABASE_URL, install pgserver for a throwaway Postgres, or pass --no-db")
+    server = pgserver.get_server(os.path.join(workdir, 'pgdata'), cleanup_mode='delete')
+    return server.get_uri().replace('postgresql://', 'postgresql+asyncpg://', 1), 'pgserver'
+
+
+async def run(args, app, main):
+    from message_codec import loads
+
+    clients = []
+    for group in range(args.groups):
+        for _ in range(args.clients_per_group):
+            ws = ASGIWebSocket(app, f'/ws/bench-group-{group}')
+            await ws.connect()
+            clients.append((group, ws))
+
+    expected = args.clients_per_group * args.messages
+    latencies = []
+    dropped = 0
+
+    async def reader(ws):
+        nonlocal dropped
+        received = 0
+        while received < expected:
+            message = await ws.receive()
+            if message['type'] == 'websocket.close':
+                dropped += 1
+                return
+            sent_at = float(loads(message['text'])['message'].split(' ', 1)[0])
+            latencies.append(time.perf_counter() - sent_at)
+            received += 1
+
+    async def sender(index, ws):
+        for seq in range(args.messages):
+            await ws.send_text(f'{{"email": "client{index}@bench", "message": "{time.perf_counter()!r} {seq}"}}')
+            # Unpaced senders still give the app a turn between frames, like a socket would
+            await asyncio.sleep(args.interval_ms / 1000)
+
+    readers = [asyncio.create_task(reader(ws)) for _, ws in clients]
+    start = time.perf_counter()
+    await asyncio.gather(*[sender(index, ws) for index, (_, ws) in enumerate(clients)])
+    sent_seconds = time.perf_counter() - start
+    done, pending = await asyncio.wait(readers, timeout=args.timeout)
+    elapsed = time.perf_counter() - start
+    for task in pending:
+        task.cancel()
+
+    for _, ws in clients:
+        await ws.close()
+    start = time.perf_counter()
+    await app.router.shutdown()
+    drain_seconds = time.perf_counter() - start
+
+    sent = len(clients) * args.messages
+    delivered = len(latencies)
+    latencies_ms = np.array(latencies) * 1000 if latencies else np.zeros(1)
+    return {
+        'clients': len(clients),
+        'messages_sent': sent,
+        'deliveries': delivered,
+        'deliveries_expected': len(clients) * expected,
+        'dropped_clients': dropped,
+        'timed_out_clients': len(pending),
+        'sent_per_second': round(sent / sent_seconds),
+        'deliveries_per_second': round(delivered / elapsed),
+        'fanout_latency_ms': {
+            'p50': round(float(np.percentile(latencies_ms, 50)), 3),
+            'p99': round(float(np.percentile(latencies_ms, 99)), 3),
+            'max': round(float(latencies_ms.max()), 3),
+        },
+        'messages_persisted': main.message_writer.written,
+        'writer_drain_seconds': round(drain_seconds, 3),
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--groups', type=int, default=10)
+    parser.add_argument('--clients-per-group', type=int, default=10)
+    parser.add_argument('--messages', type=int, default=50, help='messages sent by each client')
+    parser.add_argument('--interval-ms', type=float, default=0,
+                        help='pause between one client\'s messages; 0 sends as fast as the app accepts them')
+    parser.add_argument('--timeout', type=float, default=120)
+    parser.add_argument('--database-url')
+    parser.add_argument('--no-db', action='store_true')
+    parser.add_argument('--output')
+    args = parser.parse_args()
+    if args.output:
+        args.output = os.path.abspath(args.output)
+
+    workdir = tempfile.mkdtemp(prefix='chat-bench-')
+    database_url, database = resolve_database_url(args, workdir)
+    if database_url:
+        os.environ['DATABASE_URL'] = database_url
+    # main.py mounts ./static and ./templates from the working directory
+    os.chdir(workdir)
+    os.makedirs('static', exist_ok=True)
+    os.makedirs('templates', exist_ok=True)
+
+    import main as chat_main
+
+    async def bench():
+        if database_url is None:
+            async def skip(*_):
+                pass
+            chat_main.db_service.init_db = skip
+            chat_main.message_writer.save_batch = skip
+        await chat_main.app.router.startup()
+        return await run(args, chat_main.app, chat_main)
+
+    results = asyncio.run(bench())
+    parameters = {
+        'groups': args.groups,
+        'clients_per_group': args.clients_per_group,
+        'messages_per_client': args.messages,
+        'interval_ms': args.interval_ms,
+        'database': database,
+        'broadcast_backend': os.getenv('BROADCAST_BACKEND', 'memory'),
+    }
+    write_report('chat_fanout', parameters, results, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""Time the clustering pipeline on synthetic datasets of increasing size.
+
+    python bench/cluster_pipeline.py [--sizes 1000,10000,50000,200000] [--backend auto] [--output clustering.json]
+
+Each size runs in a fresh interpreter so that its peak RSS is its own.
+process_and_cluster covers encoding, the similarity scores, clustering and
+balancing. adjust_group_sizes and extract_clusters are then timed again on
+their own.
+"""
+import argparse
+import asyncio
+import json
+import subprocess
+import sys
+import time
+from common import peak_rss_mb, write_report
+
+DEFAULT_SIZES = '1000,10000,50000,200000'
+
+
+def run_size(n_users: int, backend: str, seed: int) -> dict:
+    from datasets import synthetic_questionnaires
+    from clustering import adjust_group_sizes, encode_questionnaires, extract_clusters, process_and_cluster
+
+    df = synthetic_questionnaires(n_users, seed)
+    baseline_rss = peak_rss_mb()
+    timings = {}
+
+    start = time.perf_counter()
+    clustered = asyncio.run(process_and_cluster(df.copy(), backend=backend))
+    timings['process_and_cluster'] = time.perf_counter() - start
+
+    _, _, features = encode_questionnaires(df.copy())
+    start = time.perf_counter()
+    adjust_group_sizes(clustered, features)
+    timings['adjust_group_sizes'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    groups = extract_clusters(clustered)
+    timings['extract_clusters'] = time.perf_counter() - start
+
+    sizes = [len(group['email'].split(',')) for group in groups]
+    return {
+        'users': n_users,
+        'seconds': {name: round(value, 3) for name, value in timings.items()},
+        'groups': len(groups),
+        'group_size_min': min(sizes),
+        'group_size_max': max(sizes),
+        'baseline_rss_mb': baseline_rss,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default=DEFAULT_SIZES, help='comma-separated user counts')
+    parser.add_argument('--backend', default=None, help='CLUSTERING_BACKEND to use (default: its env setting)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output')
+    parser.add_argument('--single', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single:
+        print(json.dumps(run_size(args.single, args.backend, args.seed)))
+        return
+
+    results = []
+    for n_users in [int(size) for size in args.sizes.split(',')]:
+        command = [sys.executable, __file__, '--single', str(n_users), '--seed', str(args.seed)]
+        if args.backend:
+            command += ['--backend', args.backend]
+        completed = subprocess.run(command, capture_output=True, text=True)
+        if completed.returncode != 0:
+            print(completed.stderr, file=sys.stderr)
+            results.append({'users': n_users, 'error': completed.stderr.strip().splitlines()[-1]})
+            continue
+        result = json.loads(completed.stdout.strip().splitlines()[-1])
+        print(f"{n_users} users: {result['seconds']}, peak RSS {result['peak_rss_mb']} MB", file=sys.stderr)
+        results.append(result)
+
+    write_report('clustering', {'sizes': args.sizes, 'backend': args.backend, 'seed': args.seed}, results, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+"""Messages per second on one core for decoding, stamping and encoding chat frames.
+
+    python bench/codec_throughput.py [--messages 100000] [--output codec.json]
+
+Compares the old handler code (json.loads, mutate, json.dumps) with
+message_codec on the standard library json and on orjson.
+"""
+import argparse
+import json
+import time
+import uuid
+from datetime import datetime
+from common import write_report
+import message_codec
+
+FRAME = json.dumps({"group_name": "Group 12", "email": "student@university.edu",
+                    "message": "Anyone up for the study session at 6? " * 3})
+
+
+def legacy(frame, group_name):
+    message_data = json.loads(frame)
+    message_data["id"] = str(uuid.uuid4())
+    message_data["group_name"] = group_name
+    message_data["timestamp"] = datetime.now()
+    return message_data, json.dumps(message_data, default=str)
+
+
+def measure(handle, messages):
+    start = time.perf_counter()
+    for _ in range(messages):
+        handle(FRAME, "Group 12")
+    return messages / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    orjson = message_codec.orjson
+    results = {'legacy': measure(legacy, args.messages)}
+    message_codec.orjson = None
+    results['codec_json'] = measure(message_codec.decode_frame, args.messages)
+    message_codec.orjson = orjson
+    if orjson is not None:
+        results['codec_orjson'] = measure(message_codec.decode_frame, args.messages)
+
+    write_report('message_codec', {'messages': args.messages, 'frame_bytes': len(FRAME)},
+                 {'messages_per_second': {name: round(rate) for name, rate in results.items()}}, args.output)
+
+if __name__ == '__main__':
+    main()
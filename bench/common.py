@@ -0,0 +1,37 @@
+"""Helpers shared by the benchmark scripts in bench/."""
+import json
+import os
+import platform
+import resource
+import sys
+from datetime import datetime, timezone
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Let the scripts import the app's modules when run as python bench/<name>.py
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process so far (ru_maxrss is KiB on Linux, bytes on macOS)"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def write_report(benchmark: str, parameters: dict, results, output: str = None) -> dict:
+    """Print the results as JSON and optionally save them, with enough context to compare runs"""
+    report = {
+        'benchmark': benchmark,
+        'created_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'parameters': parameters,
+        'results': results,
+    }
+    text = json.dumps(report, indent=2)
+    if output:
+        with open(output, 'w') as f:
+            f.write(text + '\n')
+    print(text)
+    return report
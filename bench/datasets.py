@@ -0,0 +1,43 @@
+"""Synthetic questionnaire answers shaped like the ones questionnaire.js submits."""
+import numpy as np
+import pandas as pd
+
+# The choices offered by questionnaire.html / questionnaire.js
+HOBBIES = [
+    "coding", "reading", "watching stuff", "crocheting", "drawing/painting",
+    "singing", "writing", "musical instruments", "tennis", "football", "basketball", "badminton",
+    "squash", "volleyball", "throwball",
+]
+TOPICS = [
+    "fashion", "clubs/departments", "politics", "pop culture", "world wars",
+    "history", "cricket", "Football (as a topic)", "current affairs",
+]
+GENDERS = ["Male", "Female", "Doesn't matter"]
+YEARS = ["First year", "Second year", "Third year", "Doesn't matter"]
+PURPOSES = ["To find long term friends", "Someone to attend ATMOS with"]
+# Users are drawn from a few interest profiles so the data has clusters to find
+PROFILES = 12
+
+
+def _pick(rng, choices, weights, low, high):
+    """Comma-joined picks per user, low to high items drawn without replacement from that user's weights"""
+    # Gumbel top-k: the k largest of log(weight) + Gumbel noise are a weighted sample without replacement
+    keys = np.log(weights) + rng.gumbel(size=weights.shape)
+    order = np.argsort(-keys, axis=1)
+    counts = rng.integers(low, high + 1, size=len(weights))
+    return [','.join(choices[i] for i in sorted(row[:count])) for row, count in zip(order, counts)]
+
+
+def synthetic_questionnaires(n_users: int, seed: int = 0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    hobby_weights = rng.dirichlet(np.full(len(HOBBIES), 0.5), size=PROFILES)
+    topic_weights = rng.dirichlet(np.full(len(TOPICS), 0.5), size=PROFILES)
+    profiles = rng.integers(0, PROFILES, size=n_users)
+    return pd.DataFrame({
+        'email': [f'user{i}@example.edu' for i in range(n_users)],
+        'hobbies': _pick(rng, HOBBIES, hobby_weights[profiles], 1, 5),
+        'topics': _pick(rng, TOPICS, topic_weights[profiles], 1, 4),
+        'gender': rng.choice(GENDERS, size=n_users, p=[0.45, 0.45, 0.1]),
+        'year': rng.choice(YEARS, size=n_users, p=[0.35, 0.3, 0.25, 0.1]),
+        'purpose': rng.choice(PURPOSES, size=n_users),
+    })
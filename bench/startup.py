@@ -0,0 +1,67 @@
+"""Cold start of app.py and of the Sheets API client, each in a fresh interpreter.
+
+    python bench/startup.py [--runs 5] [--output startup.json]
+
+Compares the old eager start, which imported the Google client libraries and
+called build('sheets', 'v4') while importing app.py, with the lazy start.
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+from common import ROOT, write_report
+
+# Code timed after "import app"
+SNIPPETS = {
+    # What importing app.py cost before SheetsService was lazy, minus reading token.pickle
+    'eager_import': (
+        "from google.auth.credentials import AnonymousCredentials\n"
+        "from googleapiclient.discovery import build\n"
+        "import google_auth_oauthlib.flow\n"
+        "build('sheets', 'v4', credentials=AnonymousCredentials()).spreadsheets()\n"
+    ),
+    'lazy_import': "",
+    # Lazy import plus the first request's client setup
+    'lazy_first_use': (
+        "from google.auth.credentials import AnonymousCredentials\n"
+        "from sheets_service import build_sheets\n"
+        "build_sheets(AnonymousCredentials())\n"
+    ),
+}
+
+TIMER = (
+    "import sys, time\n"
+    "sys.path.insert(0, {root!r})\n"
+    "start = time.perf_counter()\n"
+    "import app\n"
+    "{body}"
+    "print(time.perf_counter() - start)\n"
+)
+
+
+def time_snippet(body: str) -> float:
+    code = TIMER.format(root=ROOT, body=body)
+    output = subprocess.run([sys.executable, '-c', code], cwd=ROOT, check=True,
+                            capture_output=True, text=True).stdout
+    return float(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    times = {name: [] for name in SNIPPETS}
+    # Interleaved so that drift in machine load affects every variant alike
+    for _ in range(args.runs):
+        for name, body in SNIPPETS.items():
+            times[name].append(time_snippet(body))
+    results = {
+        name: {'median_ms': round(statistics.median(values) * 1000, 1), 'min_ms': round(min(values) * 1000, 1)}
+        for name, values in times.items()
+    }
+    write_report('startup', {'runs': args.runs}, results, args.output)
+
+if __name__ == '__main__':
+    main()
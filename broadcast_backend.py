@@ -0,0 +1,124 @@
+import asyncio
+import os
+from typing import Awaitable, Callable, Optional
+import asyncpg
+from sqlalchemy.engine import make_url
+from database import DATABASE_URL
+from message_codec import MessageError
+
+# memory: deliver within this process only (single worker, tests).
+# postgres: LISTEN/NOTIFY, so every worker on every host sees every message.
+BROADCAST_BACKEND = os.getenv("BROADCAST_BACKEND", "memory")
+BROADCAST_CHANNEL = os.getenv("BROADCAST_CHANNEL", "chat_messages")
+# Postgres rejects NOTIFY payloads of 8000 bytes or more
+MAX_NOTIFY_PAYLOAD = 7999
+MAX_RECONNECT_DELAY = 5.0
+
+# deliver(payload, group_name, message_id)
+Deliver = Callable[[str, str, Optional[str]], Awaitable[None]]
+
+
+class MemoryBroadcastBackend:
+    """Delivers every published message straight to this process's subscribers"""
+
+    async def start(self, deliver: Deliver):
+        self.deliver = deliver
+
+    async def publish(self, group_name: str, payload: str, message_id: Optional[str] = None):
+        await self.deliver(payload, group_name, message_id)
+
+    async def stop(self):
+        pass
+
+
+class PostgresBroadcastBackend:
+    """Pub/sub over Postgres LISTEN/NOTIFY using asyncpg.
+
+    Each worker publishes with pg_notify and listens on one dedicated
+    connection. Messages, including its own, are handed to the local
+    deliver callback in the order Postgres delivers them. When the
+    listening connection drops it is reopened with exponential backoff;
+    messages published while it is down do not reach this worker.
+    """
+
+    def __init__(self, database_url: str = DATABASE_URL, channel: str = BROADCAST_CHANNEL):
+        self.dsn = make_url(database_url).set(drivername='postgresql').render_as_string(hide_password=False)
+        self.channel = channel
+        self.listener = None
+        self.pool = None
+        self.reconnecting = None
+        self.stopping = False
+        # Deliveries in flight; the loop only keeps weak references to tasks
+        self.tasks = set()
+
+    async def start(self, deliver: Deliver):
+        self.deliver = deliver
+        self.stopping = False
+        await self._listen()
+        self.pool = await asyncpg.create_pool(self.dsn, min_size=1, max_size=4)
+
+    async def _listen(self):
+        listener = await asyncpg.connect(self.dsn)
+        await listener.add_listener(self.channel, self._on_notify)
+        listener.add_termination_listener(self._on_terminate)
+        self.listener = listener
+
+    def _on_terminate(self, connection):
+        if self.stopping or connection is not self.listener:
+            return
+        print(f"Lost the LISTEN connection for {self.channel}, reconnecting")
+        self.listener = None
+        if self.reconnecting is None or self.reconnecting.done():
+            self.reconnecting = asyncio.get_running_loop().create_task(self._reconnect())
+
+    async def _reconnect(self):
+        delay = 0.1
+        while not self.stopping:
+            try:
+                await self._listen()
+                print(f"Listening on {self.channel} again")
+                return
+            except (OSError, asyncio.TimeoutError, asyncpg.PostgresError) as e:
+                print(f"Reconnecting to {self.channel} failed, retrying in {delay:.1f}s: {str(e)}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, MAX_RECONNECT_DELAY)
+
+    async def publish(self, group_name: str, payload: str, message_id: Optional[str] = None):
+        # Encoded JSON never contains a raw newline, so the payload is passed as is
+        notification = f"{payload}\n{group_name}\n{message_id or ''}"
+        if len(notification.encode()) > MAX_NOTIFY_PAYLOAD:
+            raise MessageError("message is too large to broadcast")
+        await self.pool.execute("SELECT pg_notify($1, $2)", self.channel, notification)
+
+    def _on_notify(self, connection, pid, channel, notification):
+        envelope, _, message_id = notification.rpartition("\n")
+        payload, _, group_name = envelope.partition("\n")
+        task = asyncio.get_running_loop().create_task(self.deliver(payload, group_name, message_id or None))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def stop(self):
+        self.stopping = True
+        if self.reconnecting is not None:
+            self.reconnecting.cancel()
+            self.reconnecting = None
+        if self.listener is not None:
+            await self.listener.remove_listener(self.channel, self._on_notify)
+            await self.listener.close()
+            self.listener = None
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+
+
+BACKENDS = {
+    'memory': MemoryBroadcastBackend,
+    'postgres': PostgresBroadcastBackend,
+}
+
+
+def get_broadcast_backend(name: str = None):
+    name = name or BROADCAST_BACKEND
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown broadcast backend '{name}', expected one of: {', '.join(BACKENDS)}")
+    return BACKENDS[name]()
@@ -0,0 +1,345 @@
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import numpy as np
+from scipy import sparse
+from sklearn.cluster import AgglomerativeClustering, Birch, MiniBatchKMeans
+from sklearn.metrics.pairwise import euclidean_distances
+
+# Backend used by process_and_cluster: auto, ward, minibatch, birch or constrained.
+# "auto" keeps the Ward reference path for small cohorts and switches to the
+# size-constrained path once a dense n x n linkage would get expensive.
+CLUSTERING_BACKEND = os.getenv("CLUSTERING_BACKEND", "auto")
+WARD_MAX_ROWS = int(os.getenv("WARD_MAX_ROWS", "2000"))
+CLUSTERING_BATCH_SIZE = int(os.getenv("CLUSTERING_BATCH_SIZE", "4096"))
+# Above this many rows the scalable backends first split users into blocks of
+# about this size and cluster each block on its own, which keeps the number of
+# centroids per fit bounded instead of growing with n / 5.
+CLUSTERING_BLOCK_SIZE = int(os.getenv("CLUSTERING_BLOCK_SIZE", "500"))
+BIRCH_THRESHOLD = float(os.getenv("BIRCH_THRESHOLD", "1.0"))
+# Optional coarse key (e.g. year or purpose); users are only grouped with
+# others sharing it and every shard is clustered in its own process.
+CLUSTERING_SHARD_KEY = os.getenv("CLUSTERING_SHARD_KEY") or None
+CLUSTERING_WORKERS = int(os.getenv("CLUSTERING_WORKERS", str(os.cpu_count() or 1)))
+CLUSTERING_SEED = int(os.getenv("CLUSTERING_SEED", "0"))
+
+
+def group_count(n_rows: int, min_size: int = 4, max_size: int = 6) -> int:
+    """Number of groups for n_rows people, aiming for groups of (min_size + max_size) / 2"""
+    target = max(1, round(n_rows / ((min_size + max_size) / 2)))
+    lowest = max(1, math.ceil(n_rows / max_size))
+    highest = n_rows // min_size
+    if lowest > highest:
+        # No split keeps every group within bounds (e.g. 7 people, groups of 4-6)
+        return target
+    return min(max(target, lowest), highest)
+
+
+def _batches(n_rows: int, batch_size: int):
+    for start in range(0, n_rows, batch_size):
+        yield slice(start, min(start + batch_size, n_rows))
+
+
+def _predict_in_batches(model, features, batch_size: int) -> np.ndarray:
+    return np.concatenate([model.predict(features[rows]) for rows in _batches(features.shape[0], batch_size)])
+
+
+def ward_backend(features, n_clusters, random_state=CLUSTERING_SEED, min_size=4, max_size=6):
+    """Reference mode: exact Ward linkage on a dense copy, O(n^2) memory"""
+    dense = features.toarray() if sparse.issparse(features) else features
+    return AgglomerativeClustering(n_clusters=n_clusters, metric='euclidean', linkage='ward').fit_predict(dense)
+
+
+def minibatch_backend(features, n_clusters, random_state=CLUSTERING_SEED, min_size=4, max_size=6):
+    model = MiniBatchKMeans(
+        n_clusters=n_clusters,
+        batch_size=CLUSTERING_BATCH_SIZE,
+        n_init=1,
+        random_state=random_state,
+    )
+    model.fit(features)
+    return _predict_in_batches(model, features, CLUSTERING_BATCH_SIZE)
+
+
+def birch_backend(features, n_clusters, random_state=CLUSTERING_SEED, min_size=4, max_size=6):
+    # Build the CF-tree one batch at a time, then run the global step once
+    model = Birch(threshold=BIRCH_THRESHOLD, n_clusters=None)
+    for rows in _batches(features.shape[0], CLUSTERING_BATCH_SIZE):
+        model.partial_fit(features[rows])
+    model.set_params(n_clusters=min(n_clusters, len(model.subcluster_centers_)))
+    model.partial_fit()
+    return _predict_in_batches(model, features, CLUSTERING_BATCH_SIZE)
+
+
+def nearest_centroids(features, centroids, n_candidates: int, batch_size: int = CLUSTERING_BATCH_SIZE):
+    """Indices and distances of the n_candidates closest centroids for every row, computed in row batches"""
+    n_candidates = min(n_candidates, centroids.shape[0])
+    indices = np.empty((features.shape[0], n_candidates), dtype=np.int64)
+    distances = np.empty((features.shape[0], n_candidates), dtype=np.float64)
+    for rows in _batches(features.shape[0], batch_size):
+        block = euclidean_distances(features[rows], centroids)
+        best = np.argpartition(block, n_candidates - 1, axis=1)[:, :n_candidates]
+        best_distances = np.take_along_axis(block, best, axis=1)
+        order = np.argsort(best_distances, axis=1, kind='stable')
+        indices[rows] = np.take_along_axis(best, order, axis=1)
+        distances[rows] = np.take_along_axis(best_distances, order, axis=1)
+    return indices, distances
+
+
+def greedy_fill(features, rows, centroids, capacity, labels, budget=None, n_candidates: int = 8) -> np.ndarray:
+    """Move rows to the closest centroid with spare capacity, nearest (row, centroid) pairs first.
+
+    capacity and labels are updated in place. With a budget, a row may only
+    leave its current group while budget[group] > 0, so donor groups never drop
+    below a floor. Rows are matched against their n_candidates nearest open
+    centroids, and rows left over are retried with four times as many
+    candidates until every open centroid has been considered. Returns the
+    rows that could not be placed.
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    exhaustive = False
+    while len(rows) and np.any(capacity > 0) and not exhaustive:
+        open_groups = np.flatnonzero(capacity > 0)
+        exhaustive = n_candidates >= len(open_groups)
+        candidates, distances = nearest_centroids(features[rows], centroids[open_groups], n_candidates)
+        candidates = open_groups[candidates]
+        placed = np.zeros(len(rows), dtype=bool)
+        remaining, seats = len(rows), int(capacity.sum())
+        for flat in np.argsort(distances, axis=None, kind='stable'):
+            if remaining == 0 or seats == 0:
+                break
+            index = flat // candidates.shape[1]
+            group = candidates.flat[flat]
+            if placed[index] or capacity[group] <= 0:
+                continue
+            row = rows[index]
+            if budget is not None:
+                if budget[labels[row]] <= 0:
+                    continue
+                budget[labels[row]] -= 1
+            capacity[group] -= 1
+            labels[row] = group
+            placed[index] = True
+            remaining -= 1
+            seats -= 1
+        rows = rows[~placed]
+        if budget is not None:
+            rows = rows[budget[labels[rows]] > 0]
+        n_candidates *= 4
+    return rows
+
+
+def capacitated_assign(features, centroids, n_candidates: int = 8) -> np.ndarray:
+    """Assign every row to a centroid so that group sizes differ by at most one.
+
+    With k centroids and n rows each group receives n // k members, then the
+    n % k rows left over take one extra seat in their closest groups.
+    """
+    n_rows, n_groups = features.shape[0], centroids.shape[0]
+    labels = np.full(n_rows, -1, dtype=np.int64)
+    capacity = np.full(n_groups, n_rows // n_groups, dtype=np.int64)
+    leftover = greedy_fill(features, np.arange(n_rows), centroids, capacity, labels, n_candidates=n_candidates)
+    greedy_fill(features, leftover, centroids, np.ones(n_groups, dtype=np.int64), labels, n_candidates=n_candidates)
+    return labels
+
+
+def group_centroids(features, labels, n_groups: int) -> np.ndarray:
+    indicator = sparse.csr_matrix(
+        (np.ones(len(labels)), (labels, np.arange(len(labels)))), shape=(n_groups, len(labels))
+    )
+    sizes = np.asarray(indicator.sum(axis=1)).ravel()
+    return np.asarray((indicator @ features).todense()) / np.maximum(sizes, 1)[:, None]
+
+
+def distances_to_own_centroid(features, centroids, labels) -> np.ndarray:
+    own = centroids[labels]
+    squared = (
+        np.asarray(features.multiply(features).sum(axis=1)).ravel()
+        - 2 * np.asarray(features.multiply(own).sum(axis=1)).ravel()
+        + (own ** 2).sum(axis=1)
+    )
+    return np.sqrt(np.maximum(squared, 0))
+
+
+def balance_labels(features, labels, min_size: int = 4, max_size: int = 6, random_state=CLUSTERING_SEED) -> np.ndarray:
+    """Move as few rows as possible so that every group has min_size..max_size members.
+
+    Groups keep the centroids of the input clustering. The smallest groups
+    are dissolved while there are too many groups for the cohort, and the
+    members furthest from the centroid of the largest group seed new ones
+    while there are too few. Oversized groups then release their furthest
+    members. Undersized groups are filled, nearest first, from those
+    released rows and, if needed, from groups that have members to spare.
+    Remaining released rows go to the nearest group with room. Ties are
+    broken by a permutation seeded with random_state, so the result is
+    reproducible. When no split of n_rows fits the bounds (fewer than
+    min_size users, or 7 users with groups of 4-6) the result is as close
+    as possible.
+    """
+    n_rows = features.shape[0]
+    if n_rows == 0:
+        return np.asarray(labels, dtype=np.int64)
+    order = np.random.RandomState(random_state).permutation(n_rows)
+    features = sparse.csr_matrix(features)[order]
+    labels = np.unique(np.asarray(labels)[order], return_inverse=True)[1].astype(np.int64)
+
+    sizes = np.bincount(labels)
+    centroids = group_centroids(features, labels, len(sizes))
+    fewest = max(1, math.ceil(n_rows / max_size))
+    most = max(1, n_rows // min_size)
+    if fewest > most:
+        fewest = most = group_count(n_rows, min_size, max_size)
+
+    released = []
+    active = np.ones(len(sizes), dtype=bool)
+    if len(sizes) > most:
+        dissolved = np.argsort(sizes, kind='stable')[:len(sizes) - most]
+        active[dissolved] = False
+        released.append(np.flatnonzero(np.isin(labels, dissolved)))
+        sizes[dissolved] = 0
+
+    distances = distances_to_own_centroid(features, centroids, labels)
+    while active.sum() < fewest:
+        largest = int(np.argmax(np.where(active, sizes, -1)))
+        members = np.flatnonzero(labels == largest)
+        seed = members[np.argmax(distances[members])]
+        centroids = np.vstack([centroids, features[seed].toarray()])
+        sizes[largest] -= 1
+        sizes = np.append(sizes, 1)
+        active = np.append(active, True)
+        labels[seed] = len(sizes) - 1
+        distances[seed] = 0.0
+
+    oversized = np.flatnonzero(active & (sizes > max_size))
+    if len(oversized):
+        rows = np.flatnonzero(np.isin(labels, oversized))
+        rows = rows[np.lexsort((-distances[rows], labels[rows]))]
+        rank = np.arange(len(rows)) - np.searchsorted(labels[rows], labels[rows])
+        released.append(rows[rank >= max_size])
+        sizes[oversized] = max_size
+
+    released = np.concatenate(released) if released else np.empty(0, dtype=np.int64)
+    labels[released] = -1
+
+    capacity = np.where(active, np.maximum(min_size - sizes, 0), 0)
+    released = greedy_fill(features, released, centroids, capacity, labels)
+    if np.any(capacity > 0):
+        sizes = np.bincount(labels[labels >= 0], minlength=len(sizes))
+        budget = np.where(active, np.maximum(sizes - min_size, 0), 0)
+        donors = np.flatnonzero((labels >= 0) & (budget[np.maximum(labels, 0)] > 0))
+        greedy_fill(features, donors, centroids, capacity, labels, budget=budget)
+
+    sizes = np.bincount(labels[labels >= 0], minlength=len(sizes))
+    capacity = np.where(active, np.maximum(max_size - sizes, 0), 0)
+    released = greedy_fill(features, released, centroids, capacity, labels)
+    if len(released):
+        # Only reachable when the bounds cannot be met; keep everyone in their nearest group
+        groups = np.flatnonzero(active)
+        labels[released] = groups[nearest_centroids(features[released], centroids[groups], 1)[0][:, 0]]
+
+    balanced = np.empty(n_rows, dtype=np.int64)
+    balanced[order] = np.unique(labels, return_inverse=True)[1]
+    return balanced
+
+
+def constrained_backend(features, n_clusters, random_state=CLUSTERING_SEED, min_size=4, max_size=6):
+    """Groups of min_size..max_size directly: mini-batch k-means centroids plus a capacitated assignment"""
+    n_groups = group_count(features.shape[0], min_size, max_size)
+    model = MiniBatchKMeans(
+        n_clusters=n_groups,
+        batch_size=CLUSTERING_BATCH_SIZE,
+        n_init=1,
+        random_state=random_state,
+    )
+    model.fit(features)
+    return capacitated_assign(features, model.cluster_centers_)
+
+
+BACKENDS = {
+    'ward': ward_backend,
+    'minibatch': minibatch_backend,
+    'birch': birch_backend,
+    'constrained': constrained_backend,
+}
+
+
+def partition_blocks(features, block_size: int = CLUSTERING_BLOCK_SIZE, random_state=CLUSTERING_SEED) -> np.ndarray:
+    """Split rows into equally sized blocks of similar users using mini-batch k-means centroids"""
+    n_blocks = math.ceil(features.shape[0] / block_size)
+    model = MiniBatchKMeans(n_clusters=n_blocks, batch_size=CLUSTERING_BATCH_SIZE, n_init=3, random_state=random_state)
+    model.fit(features)
+    return capacitated_assign(features, model.cluster_centers_)
+
+
+def get_backend(name: str = None, n_rows: int = 0):
+    name = name or CLUSTERING_BACKEND
+    if name == 'auto':
+        name = 'ward' if n_rows <= WARD_MAX_ROWS else 'constrained'
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown clustering backend '{name}', expected one of: auto, {', '.join(BACKENDS)}")
+    return BACKENDS[name]
+
+
+def cluster_features(features, n_clusters, backend: str = None, random_state=CLUSTERING_SEED, min_size=4, max_size=6):
+    """Cluster the rows of the encoded feature matrix with the configured backend"""
+    n_rows = features.shape[0]
+    fit_predict = get_backend(backend, n_rows)
+    if fit_predict is ward_backend or n_rows <= CLUSTERING_BLOCK_SIZE:
+        return np.asarray(fit_predict(features, n_clusters, random_state=random_state, min_size=min_size, max_size=max_size))
+
+    blocks = partition_blocks(features, CLUSTERING_BLOCK_SIZE, random_state)
+    labels = np.empty(n_rows, dtype=np.int64)
+    offset = 0
+    for block in range(blocks.max() + 1):
+        rows = np.flatnonzero(blocks == block)
+        block_clusters = max(1, round(n_clusters * len(rows) / n_rows))
+        block_labels = np.asarray(fit_predict(
+            features[rows], block_clusters, random_state=random_state, min_size=min_size, max_size=max_size
+        ))
+        # Balance while the candidate groups are limited to this block, which keeps it linear overall
+        block_labels = balance_labels(features[rows], block_labels, min_size, max_size, random_state)
+        labels[rows] = block_labels + offset
+        offset += block_labels.max() + 1
+    return labels
+
+
+def _cluster_shard(features, backend, random_state, min_size, max_size):
+    n_clusters = max(1, features.shape[0] // 5)
+    labels = cluster_features(features, n_clusters, backend, random_state, min_size, max_size)
+    return balance_labels(features, labels, min_size, max_size, random_state)
+
+
+def cluster_sharded(features, shard_keys, backend: str = None, random_state=CLUSTERING_SEED,
+                    min_size=4, max_size=6, workers: int = CLUSTERING_WORKERS) -> np.ndarray:
+    """Cluster and balance each shard separately, in parallel, and merge into one label space.
+
+    Shards are processed in sorted key order with the same seed, so the result
+    does not depend on the number of workers. Shards too small to form valid
+    groups on their own (fewer than 2 * min_size users) are pooled together.
+    """
+    shard_keys = np.asarray(shard_keys).astype(str)
+    keys, inverse, counts = np.unique(shard_keys, return_inverse=True, return_counts=True)
+    shards = [np.flatnonzero(inverse == i) for i in range(len(keys)) if counts[i] >= 2 * min_size]
+    pooled = np.flatnonzero(np.isin(inverse, np.flatnonzero(counts < 2 * min_size)))
+    if len(pooled):
+        if len(pooled) >= 2 * min_size or not shards:
+            shards.append(pooled)
+        else:
+            smallest = min(range(len(shards)), key=lambda i: len(shards[i]))
+            shards[smallest] = np.sort(np.concatenate([shards[smallest], pooled]))
+
+    args = [(features[rows], backend, random_state, min_size, max_size) for rows in shards]
+    if workers > 1 and len(shards) > 1:
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=min(workers, len(shards)), mp_context=context) as executor:
+            results = list(executor.map(_cluster_shard, *zip(*args)))
+    else:
+        results = [_cluster_shard(*shard_args) for shard_args in args]
+
+    labels = np.empty(features.shape[0], dtype=np.int64)
+    offset = 0
+    for rows, shard_labels in zip(shards, results):
+        labels[rows] = shard_labels + offset
+        offset += shard_labels.max() + 1
+    return labels
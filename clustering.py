@@ -1,71 +1,97 @@
 import pandas as pd
-from sklearn.metrics.pairwise import euclidean_distances
-from sklearn.cluster import AgglomerativeClustering
-from collections import Counter
+import numpy as np
+import os
 import uuid
-from database import db_service
+from database import CLUSTERING_LOCK_KEY, QUESTIONNAIRE_CHUNK_SIZE, db_service
+from features import FeatureEncoder, FEATURE_FIELDS
+from cluster_backends import CLUSTERING_SEED, CLUSTERING_SHARD_KEY, balance_labels, cluster_features, cluster_sharded
+from incremental import GroupModel, set_group_model
+from clustering_cache import CLUSTERING_CACHE_MAX_CHANGED, ClusteringCache
+from suggestions import SUGGESTIONS_INDEX_PATH, SUGGESTIONS_K, SuggestionIndex, set_suggestion_index
 import asyncio
 
-async def process_and_cluster(df):
-    df['hobbies'] = df['hobbies'].apply(lambda x: x.split(','))
-    df['topics'] = df['topics'].apply(lambda x: x.split(','))
-
-    unique_hobbies = set(hobby.strip() for sublist in df['hobbies'] for hobby in sublist)
-    unique_topics = set(topic.strip() for sublist in df['topics'] for topic in sublist)
-
-    for hobby in unique_hobbies:
-        df[hobby] = df['hobbies'].apply(lambda x: 1 if hobby in [h.strip() for h in x] else 0)
-    for topic in unique_topics:
-        df[topic] = df['topics'].apply(lambda x: 1 if topic in [t.strip() for t in x] else 0)
-
-    df = pd.get_dummies(df, columns=['gender', 'year'], drop_first=True)
-    df.drop(['hobbies', 'topics'], axis=1, inplace=True)
-
+# Rows of the per-user mean distance computation handled per block; peak
+# memory is about chunk_size x (number of distinct answer sets) floats.
+SIMILARITY_CHUNK_SIZE = int(os.getenv("SIMILARITY_CHUNK_SIZE", "1024"))
+# New submissions are placed incrementally, so the full recluster only has to
+# run this often (default every 24 hours) or when the groups have drifted.
+REBALANCE_INTERVAL = int(os.getenv("REBALANCE_INTERVAL", str(24 * 60 * 60)))
+
+def mean_euclidean_distances(features, chunk_size=SIMILARITY_CHUNK_SIZE):
+    """Mean euclidean distance from each row to every row, without an n x n matrix"""
+    features = features.tocsr()
+    features.sort_indices()
+    # Identical answer sets have identical distances, so work on distinct rows weighted by count
+    row_keys = {}
+    inverse = np.empty(features.shape[0], dtype=np.int64)
+    for i in range(features.shape[0]):
+        start, end = features.indptr[i], features.indptr[i + 1]
+        key = (features.indices[start:end].tobytes(), features.data[start:end].tobytes())
+        inverse[i] = row_keys.setdefault(key, len(row_keys))
+    first_rows = np.zeros(len(row_keys), dtype=np.int64)
+    first_rows[inverse[::-1]] = np.arange(features.shape[0])[::-1]
+    unique = features[first_rows]
+    weights = np.bincount(inverse, minlength=len(row_keys)).astype(np.float64)
+
+    squared_norms = np.asarray(unique.multiply(unique).sum(axis=1)).ravel()
+    means = np.empty(unique.shape[0], dtype=np.float64)
+    for start in range(0, unique.shape[0], chunk_size):
+        end = min(start + chunk_size, unique.shape[0])
+        block = np.asarray((unique[start:end] @ unique.T).todense())
+        block *= -2
+        block += squared_norms[start:end, None]
+        block += squared_norms[None, :]
+        np.maximum(block, 0, out=block)
+        np.sqrt(block, out=block)
+        means[start:end] = block @ weights
+    return means[inverse] / features.shape[0]
+
+def encode_questionnaires(df):
+    encoder = FeatureEncoder()
+    features = encoder.fit_transform(df)
+    df = df.drop(columns=[c for c in FEATURE_FIELDS if c in df.columns]).reset_index(drop=True)
+    return df, encoder, features
+
+async def process_and_cluster(df, backend=None, chunk_size=SIMILARITY_CHUNK_SIZE):
+    df, encoder, features = encode_questionnaires(df)
+    return cluster_encoded(df, encoder, features, backend=backend, chunk_size=chunk_size)
+
+def cluster_encoded(df, encoder, features, backend=None, chunk_size=SIMILARITY_CHUNK_SIZE, shard_key=CLUSTERING_SHARD_KEY):
     # Make sure we have enough data to create clusters
     if len(df) < 5:
         print("Not enough data for clustering. Minimum 5 entries required.")
         return df
-        
-    hobbies_distances = euclidean_distances(df[list(unique_hobbies)])
-    topics_distances = euclidean_distances(df[list(unique_topics)])
-    df['hobbies_similarity'] = 1 / (1 + hobbies_distances.mean(axis=1))
-    df['topics_similarity'] = 1 / (1 + topics_distances.mean(axis=1))
+
+    hobbies_distances = mean_euclidean_distances(features[:, encoder.field_slice('hobbies')], chunk_size)
+    topics_distances = mean_euclidean_distances(features[:, encoder.field_slice('topics')], chunk_size)
+    df['hobbies_similarity'] = 1 / (1 + hobbies_distances)
+    df['topics_similarity'] = 1 / (1 + topics_distances)
     df['combined_similarity'] = (df['hobbies_similarity'] + df['topics_similarity']) / 2
 
-    clustering_data = df.drop(columns=['email', 'purpose', 'hobbies_similarity', 'topics_similarity', 'combined_similarity'])
-    
     # Calculate number of groups (1 group per 5 people, minimum 1)
     num_groups = max(1, len(df) // 5)
-    agg_cluster = AgglomerativeClustering(n_clusters=num_groups, affinity='euclidean', linkage='ward')
-    df['cluster'] = agg_cluster.fit_predict(clustering_data)
-
-    return adjust_group_sizes(df, min_size=4, max_size=6)
-
-def adjust_group_sizes(df, min_size=4, max_size=6):
-    from random import choice
-    group_sizes = Counter(df['cluster'])
-    small_groups = [group for group, size in group_sizes.items() if size < min_size]
-    large_groups = [group for group, size in group_sizes.items() if size > max_size]
-
-    for group in large_groups:
-        while group_sizes[group] > max_size:
-            individual_index = choice(df[df['cluster'] == group].index)
-            if small_groups:
-                new_group = choice(small_groups)
-                df.at[individual_index, 'cluster'] = new_group
-                group_sizes[group] -= 1
-                group_sizes[new_group] += 1
-            else:
-                break  # No small groups to transfer to
+    if shard_key:
+        df['cluster'] = cluster_sharded(features, shard_keys(df, encoder, features, shard_key), backend=backend)
+    else:
+        df['cluster'] = cluster_features(features, num_groups, backend=backend)
+
+    return adjust_group_sizes(df, features, min_size=4, max_size=6)
+
+def shard_keys(df, encoder, features, key):
+    if key in df.columns:
+        return df[key].fillna('').astype(str).to_numpy()
+    return encoder.categories(features, key)
 
+def adjust_group_sizes(df, features, min_size=4, max_size=6, random_state=CLUSTERING_SEED):
+    df['cluster'] = balance_labels(features, df['cluster'].to_numpy(), min_size, max_size, random_state)
     return df
 
 def extract_clusters(df):
-    clusters = df['cluster'].unique()
     grouped_data = []
-    for cluster in clusters:
+    # One pass over the rows; groups come out in order of first appearance, as with unique()
+    for cluster, emails in df.groupby('cluster', sort=False)['email']:
         group_name = f'Group {cluster + 1}'
-        members = df[df['cluster'] == cluster]['email'].tolist()
+        members = emails.tolist()
         grouped_data.append({
             'id': str(uuid.uuid4()),
             'group_name': group_name,
@@ -73,37 +99,118 @@ def extract_clusters(df):
         })
     return grouped_data
 
-async def run_clustering():
+def _report(progress, stage, **details):
+    if progress is not None:
+        progress(stage, **details)
+
+async def load_encoded_questionnaires(chunk_size=QUESTIONNAIRE_CHUNK_SIZE, progress=None):
+    """Stream the questionnaire table and encode it chunk by chunk.
+
+    Returns (df, row_hashes, encoder, features), row_hashes being each row's
+    hash in df order.
+    """
+    encoder = FeatureEncoder()
+    columns = {}
+    row_hashes = []
+    rows = 0
+    async for chunk in db_service.stream_questionnaire_data(chunk_size, with_hash=True):
+        rows += len(chunk)
+        _report(progress, 'loading', rows=rows)
+        encoder.partial_fit(chunk)
+        for row in chunk:
+            row_hashes.append(row.pop('row_hash'))
+            for key, value in row.items():
+                if key not in FEATURE_FIELDS:
+                    columns.setdefault(key, []).append(value)
+    features = encoder.finalize()
+    return pd.DataFrame(columns), row_hashes, encoder, features
+
+async def load_changed_questionnaires(cache, chunk_size=QUESTIONNAIRE_CHUNK_SIZE, progress=None):
+    """Reuse the cached encoding for unchanged rows and fetch only the rest.
+
+    Returns what load_encoded_questionnaires does, plus the number of rows
+    reused, or None when too much changed or the vocabulary would change.
+    """
+    hashes = []
+    async for chunk in db_service.stream_questionnaire_hashes(chunk_size):
+        hashes.extend(chunk)
+    changed = cache.changed_emails(hashes)
+    if len(changed) > CLUSTERING_CACHE_MAX_CHANGED * len(hashes):
+        return None
+    _report(progress, 'loading', rows=len(changed), reused=len(hashes) - len(changed))
+    patched = cache.patch(hashes, await db_service.get_questionnaires(changed, chunk_size=chunk_size))
+    if patched is None:
+        return None
+    return patched + (len(hashes) - len(changed),)
+
+async def run_clustering(progress=None, force=False):
+    """Recluster everyone and save the groups.
+
+    progress, if given, is called as progress(stage, **details) as the job
+    moves through loading, clustering and saving. Returns a summary dict.
+    When neither the questionnaire table nor the current groups changed
+    since the last run, the groups are kept as they are unless force is set.
+    """
     try:
-        # Get questionnaire data from PostgreSQL
-        questionnaire_data = await db_service.get_questionnaire_data()
-        if not questionnaire_data:
+        cache = None if force else ClusteringCache.load()
+        if cache is not None and cache.matches(await db_service.questionnaire_fingerprint()):
+            print("Clustering skipped - questionnaire data unchanged")
+            if SUGGESTIONS_K > 0 and not os.path.exists(SUGGESTIONS_INDEX_PATH):
+                _report(progress, 'indexing', users=cache.rows)
+                set_suggestion_index(SuggestionIndex.build(cache.encoder, cache.features, cache.df['email'].tolist()))
+            return {"users": cache.rows, "groups": cache.groups, "generation": cache.generation, "unchanged": True}
+
+        loaded = None
+        if cache is not None:
+            loaded = await load_changed_questionnaires(cache, progress=progress)
+        if loaded is None:
+            # Stream questionnaire data from PostgreSQL
+            loaded = await load_encoded_questionnaires(progress=progress) + (0,)
+        df, row_hashes, encoder, features, reused = loaded
+        if df.empty:
             print("No questionnaire data found")
-            return
+            return {"users": 0, "groups": 0}
 
-        # Convert to DataFrame
-        df = pd.DataFrame(questionnaire_data)
-        
         # Process and cluster
-        clustered_df = await process_and_cluster(df)
+        _report(progress, 'clustering', users=len(df))
+        input_columns = list(df.columns)
+        clustered_df = cluster_encoded(df, encoder, features)
         
         # If we have cluster data (might not if insufficient data)
         if 'cluster' in clustered_df.columns:
             groups = extract_clusters(clustered_df)
             # Save groups to PostgreSQL
-            await db_service.save_groups(groups)
+            _report(progress, 'saving', groups=len(groups))
+            generation = await db_service.save_groups(groups)
+            # Keep the centroids so new submissions can join these groups right away
+            set_group_model(GroupModel.fit(encoder, features, clustered_df['email'].tolist(), groups))
+            if SUGGESTIONS_K > 0:
+                _report(progress, 'indexing', users=len(clustered_df))
+                set_suggestion_index(SuggestionIndex.build(encoder, features, clustered_df['email'].tolist()))
+            ClusteringCache(clustered_df[input_columns], row_hashes, encoder, features,
+                            clustered_df['cluster'].to_numpy(), len(groups), generation).save()
             print("Clustering completed successfully")
+            return {"users": len(clustered_df), "groups": len(groups), "generation": generation, "reused": reused}
         else:
             print("Clustering skipped - not enough data")
+            return {"users": len(df), "groups": 0}
             
     except Exception as e:
         print(f"Error during clustering: {str(e)}")
         raise
 
+async def run_clustering_locked(progress=None, force=False):
+    """run_clustering, unless another process or host is already clustering"""
+    async with db_service.try_advisory_lock(CLUSTERING_LOCK_KEY) as acquired:
+        if not acquired:
+            print("Clustering skipped - another clustering job is running")
+            return {"skipped": True}
+        return await run_clustering(progress, force)
+
 async def schedule_clustering():
     while True:
-        await run_clustering()
-        await asyncio.sleep(24 * 60 * 60)  # Run every 24 hours
+        await run_clustering_locked()
+        await asyncio.sleep(REBALANCE_INTERVAL)
 
 if __name__ == "__main__":
     asyncio.run(schedule_clustering())
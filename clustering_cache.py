@@ -0,0 +1,101 @@
+import hashlib
+import os
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from typing import Any, Dict, List, Optional
+from features import FeatureEncoder
+from pickle_store import load_pickle, save_pickle
+
+CLUSTERING_CACHE_PATH = os.getenv("CLUSTERING_CACHE_PATH", "clustering_cache.pickle")
+# Above this share of changed rows the job re-encodes everything instead of patching the cache
+CLUSTERING_CACHE_MAX_CHANGED = float(os.getenv("CLUSTERING_CACHE_MAX_CHANGED", "0.2"))
+
+
+def fingerprint_digest(row_hashes: List[str]) -> str:
+    """Same digest as DatabaseService.questionnaire_fingerprint, from row hashes in email order"""
+    if not row_hashes:
+        return ''
+    return hashlib.md5(''.join(row_hashes).encode()).hexdigest()
+
+
+class ClusteringCache:
+    """Encoded input and result of the last clustering run.
+
+    Keyed by a fingerprint of the questionnaire table (row count plus a
+    digest of every row's hash) and by the group generation the run saved,
+    so an unchanged table with untouched groups needs no recluster.
+    """
+
+    def __init__(self, df: pd.DataFrame, row_hashes: List[str], encoder: FeatureEncoder, features,
+                 labels, groups: int, generation: Optional[int]):
+        self.df = df
+        self.row_hashes = row_hashes
+        self.encoder = encoder
+        self.features = features
+        self.labels = labels
+        self.groups = groups
+        self.generation = generation
+        self.rows = len(row_hashes)
+        self.digest = fingerprint_digest(row_hashes)
+
+    def matches(self, fingerprint: Dict[str, Any]) -> bool:
+        return (self.rows, self.digest, self.generation) == (
+            fingerprint['rows'], fingerprint['digest'], fingerprint['generation']
+        )
+
+    def patch(self, hashes: List[tuple], changed_rows: List[Dict[str, Any]]):
+        """Rebuild the encoded input from cached rows plus the rows that changed.
+
+        hashes is every (email, row_hash) in email order; changed_rows are the
+        fetched rows, with row_hash, of new or edited emails. Returns
+        (df, row_hashes, encoder, features), or None when a changed row has
+        an answer outside the cached vocabulary and a full encode is needed.
+        """
+        tokenized = FeatureEncoder.tokenize(changed_rows)
+        if not self.encoder.covers_tokens(tokenized):
+            return None
+        changed_features = self.encoder.transform_tokens(tokenized)
+        changed_df = pd.DataFrame(changed_rows, columns=list(self.df.columns) + ['row_hash'])
+
+        cached = {email: i for i, email in enumerate(self.df['email'])}
+        changed = {email: len(self.df) + i for i, email in enumerate(changed_df['email'])}
+        changed_hashes = changed_df.pop('row_hash').tolist()
+        positions = []
+        row_hashes = []
+        for email, row_hash in hashes:
+            if email in changed:
+                position = changed[email]
+                row_hashes.append(changed_hashes[position - len(self.df)])
+            elif email in cached and self.row_hashes[cached[email]] == row_hash:
+                position = cached[email]
+                row_hashes.append(row_hash)
+            else:
+                # Edited or added after changed_rows were fetched; the next run picks it up
+                continue
+            positions.append(position)
+
+        positions = np.asarray(positions, dtype=np.int64)
+        features = sparse.vstack([self.features, changed_features], format='csr')[positions]
+        df = pd.concat([self.df, changed_df], ignore_index=True).iloc[positions].reset_index(drop=True)
+        return df, row_hashes, self.encoder, features
+
+    def changed_emails(self, hashes: List[tuple]) -> List[str]:
+        """Emails in hashes that are new or whose row differs from the cached one"""
+        cached = dict(zip(self.df['email'], self.row_hashes))
+        return [email for email, row_hash in hashes if cached.get(email) != row_hash]
+
+    def save(self, path: str = CLUSTERING_CACHE_PATH):
+        save_pickle(self, path)
+
+    @classmethod
+    def load(cls, path: str = CLUSTERING_CACHE_PATH) -> Optional['ClusteringCache']:
+        try:
+            cache = load_pickle(path)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            # A cache from an older version or a torn write just means a full run
+            print(f"Ignoring clustering cache {path}: {str(e)}")
+            return None
+        return cache if isinstance(cache, cls) else None
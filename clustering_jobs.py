@@ -0,0 +1,155 @@
+import asyncio
+import multiprocessing
+import os
+import queue
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+from typing import Any, Callable, Dict, Optional, Tuple
+
+# Finished jobs whose status can still be looked up
+CLUSTERING_JOBS_KEPT = int(os.getenv("CLUSTERING_JOBS_KEPT", "20"))
+PROGRESS_POLL_INTERVAL = 0.25
+
+_progress_queue = None
+
+
+def _init_worker(progress_queue):
+    global _progress_queue
+    _progress_queue = progress_queue
+
+
+def _run_job(job_id: str, force: bool = False) -> Dict[str, Any]:
+    """Entry point in the worker process"""
+    from clustering import run_clustering_locked
+
+    def progress(stage, **details):
+        _progress_queue.put((job_id, stage, details))
+
+    return asyncio.run(run_clustering_locked(progress, force))
+
+
+class ClusteringJob:
+    def __init__(self, reason: str, force: bool = False):
+        self.id = str(uuid.uuid4())
+        self.reason = reason
+        self.force = force
+        self.status = 'queued'
+        self.stage = None
+        self.progress: Dict[str, Any] = {}
+        self.result: Optional[Dict[str, Any]] = None
+        self.error: Optional[str] = None
+        self.created_at = datetime.now()
+        self.started_at = None
+        self.finished_at = None
+
+    @property
+    def active(self) -> bool:
+        return self.status in ('queued', 'running')
+
+    def to_dict(self) -> Dict[str, Any]:
+        end = self.finished_at or datetime.now()
+        return {
+            'id': self.id,
+            'reason': self.reason,
+            'force': self.force,
+            'status': self.status,
+            'stage': self.stage,
+            'progress': self.progress,
+            'result': self.result,
+            'error': self.error,
+            'created_at': self.created_at.isoformat(),
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+            'elapsed_seconds': round((end - self.started_at).total_seconds(), 3) if self.started_at else None,
+        }
+
+
+class ClusteringJobs:
+    """Runs clustering jobs one at a time in a separate process.
+
+    The pandas and scikit-learn work never touches the event loop, so chat
+    and HTTP requests are served while a recluster runs. Submitting while a
+    job is queued or running returns that job instead of starting another.
+    Across workers and hosts, a Postgres advisory lock lets only one job
+    cluster at a time; the others finish with status "skipped".
+    """
+
+    def __init__(self, on_finished: Optional[Callable[[ClusteringJob], None]] = None,
+                 kept: int = CLUSTERING_JOBS_KEPT):
+        self.jobs: "OrderedDict[str, ClusteringJob]" = OrderedDict()
+        self.current: Optional[ClusteringJob] = None
+        self.on_finished = on_finished
+        self.kept = kept
+        self.executor = None
+        self.progress_queue = None
+        self.task = None
+
+    def submit(self, reason: str = 'manual', force: bool = False) -> Tuple[ClusteringJob, bool]:
+        """Start a job unless one is active; returns the job and whether it is new.
+
+        force reclusters even when the questionnaire data is unchanged.
+        """
+        if self.current is not None and self.current.active:
+            return self.current, False
+        job = ClusteringJob(reason, force)
+        self.jobs[job.id] = job
+        while len(self.jobs) > self.kept:
+            self.jobs.popitem(last=False)
+        self.current = job
+        self.task = asyncio.create_task(self._run(job))
+        return job, True
+
+    def get(self, job_id: str) -> Optional[ClusteringJob]:
+        return self.jobs.get(job_id)
+
+    def _start_executor(self):
+        # spawn, because forking a process with a running event loop and open
+        # database connections is unsafe; one task per child returns its memory
+        context = multiprocessing.get_context('spawn')
+        self.progress_queue = context.Queue()
+        self.executor = ProcessPoolExecutor(max_workers=1, mp_context=context, max_tasks_per_child=1,
+                                            initializer=_init_worker, initargs=(self.progress_queue,))
+
+    async def _run(self, job: ClusteringJob):
+        try:
+            if self.executor is None:
+                self._start_executor()
+            job.status = 'running'
+            job.started_at = datetime.now()
+            future = asyncio.wrap_future(self.executor.submit(_run_job, job.id, job.force))
+            while not future.done():
+                await asyncio.wait({future}, timeout=PROGRESS_POLL_INTERVAL)
+                self._drain_progress()
+            job.result = future.result()
+            job.status = 'skipped' if job.result.get('skipped') else 'succeeded'
+            job.stage = 'done'
+        except Exception as e:
+            if isinstance(e, BrokenProcessPool):
+                # The worker died (e.g. out of memory); start a fresh pool for the next job
+                self.shutdown()
+            print(f"Clustering job {job.id} failed: {str(e)}")
+            job.status = 'failed'
+            job.error = str(e)
+        finally:
+            job.finished_at = datetime.now()
+            if self.on_finished is not None:
+                self.on_finished(job)
+
+    def _drain_progress(self):
+        while True:
+            try:
+                job_id, stage, details = self.progress_queue.get_nowait()
+            except queue.Empty:
+                return
+            job = self.jobs.get(job_id)
+            if job is not None and job.active:
+                job.stage = stage
+                job.progress = details
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
@@ -0,0 +1,190 @@
+import asyncio
+import json
+import os
+import sys
+from collections import OrderedDict, deque
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Union
+from fastapi import WebSocket
+from message_codec import dumps
+
+# Messages that may wait for one client before it is considered too slow and dropped
+WS_OUTBOUND_QUEUE_SIZE = int(os.getenv("WS_OUTBOUND_QUEUE_SIZE", "256"))
+WS_SEND_TIMEOUT = float(os.getenv("WS_SEND_TIMEOUT", "5"))
+# WebSocket close code sent to clients that fell too far behind ("try again later")
+SLOW_CLIENT_CLOSE_CODE = 1013
+# Recent messages kept for clients that reconnect with the id of the last one
+# they saw: at most this many per group, and this many bytes over all groups
+WS_REPLAY_BUFFER_SIZE = int(os.getenv("WS_REPLAY_BUFFER_SIZE", "100"))
+WS_REPLAY_BUFFER_BYTES = int(os.getenv("WS_REPLAY_BUFFER_BYTES", str(16 * 1024 * 1024)))
+# Most messages replayed from the database when the gap is larger than the buffer
+WS_REPLAY_LIMIT = int(os.getenv("WS_REPLAY_LIMIT", "200"))
+
+# history(group_name, last_id, limit): the newest `limit` messages after last_id,
+# oldest first, or None when last_id is unknown
+History = Callable[[str, str, int], Awaitable[Optional[List[Dict[str, Any]]]]]
+
+
+class Connection:
+    def __init__(self, websocket: WebSocket, max_queue: int):
+        self.websocket = websocket
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+        self.task = None
+
+
+class ReplayBuffer:
+    """The last few messages of each group, as (id, payload) pairs.
+
+    Bounded per group by count and over all groups by payload size; when
+    over the size cap, the groups written to least recently lose their
+    oldest messages first.
+    """
+
+    def __init__(self, size: int = WS_REPLAY_BUFFER_SIZE, max_bytes: int = WS_REPLAY_BUFFER_BYTES):
+        self.size = size
+        self.max_bytes = max_bytes
+        self.groups: "OrderedDict[str, deque]" = OrderedDict()
+        self.bytes = 0
+
+    def append(self, group_name: str, message_id: str, payload: str):
+        if self.size <= 0:
+            return
+        messages = self.groups.get(group_name)
+        if messages is None:
+            messages = self.groups[group_name] = deque()
+        self.groups.move_to_end(group_name)
+        messages.append((message_id, payload))
+        self.bytes += sys.getsizeof(payload)
+        if len(messages) > self.size:
+            self._pop(group_name)
+        while self.bytes > self.max_bytes and self.groups:
+            self._pop(next(iter(self.groups)))
+
+    def _pop(self, group_name: str):
+        messages = self.groups[group_name]
+        _, payload = messages.popleft()
+        self.bytes -= sys.getsizeof(payload)
+        if not messages:
+            del self.groups[group_name]
+
+    def snapshot(self, group_name: str) -> List[tuple]:
+        return list(self.groups.get(group_name, ()))
+
+    @staticmethod
+    def after(messages: List[tuple], last_id: str) -> Optional[List[str]]:
+        """Payloads after last_id in a snapshot, or None if last_id is not in it"""
+        for position in range(len(messages) - 1, -1, -1):
+            if messages[position][0] == last_id:
+                return [payload for _, payload in messages[position + 1:]]
+        return None
+
+
+class ConnectionManager:
+    """Tracks WebSocket connections per group and fans messages out to them.
+
+    Every connection has its own bounded outbound queue drained by its own
+    sender task, so a slow or dead client never delays the rest of its
+    group. Clients whose queue overflows are disconnected, and sockets that
+    fail or time out on send are removed automatically.
+
+    Recent messages are kept in a ReplayBuffer. A client that connects with
+    the id of the last message it saw first gets everything sent after it:
+    from the buffer, or from history() when the gap is larger than the buffer.
+    """
+
+    def __init__(self, max_queue: int = WS_OUTBOUND_QUEUE_SIZE, send_timeout: float = WS_SEND_TIMEOUT,
+                 history: Optional[History] = None, replay_limit: int = WS_REPLAY_LIMIT):
+        self.active_connections: Dict[str, Dict[WebSocket, Connection]] = {}
+        self.max_queue = max_queue
+        self.send_timeout = send_timeout
+        self.history = history
+        self.replay_limit = replay_limit
+        self.replay = ReplayBuffer()
+        # Closes of dropped slow clients; the loop only keeps weak references to tasks
+        self.tasks = set()
+
+    async def connect(self, websocket: WebSocket, group_name: str, last_id: Optional[str] = None):
+        await websocket.accept()
+        connection = Connection(websocket, self.max_queue)
+        # Taken together with registering, so every message is either in the
+        # snapshot or queued for the connection, never both or neither
+        buffered = self.replay.snapshot(group_name) if last_id else None
+        connection.task = asyncio.create_task(self._sender(connection, group_name, last_id, buffered))
+        self.active_connections.setdefault(group_name, {})[websocket] = connection
+
+    def disconnect(self, websocket: WebSocket, group_name: str):
+        connection = self._remove(websocket, group_name)
+        if connection is not None and connection.task is not asyncio.current_task():
+            connection.task.cancel()
+
+    async def broadcast(self, message: Union[str, Dict[str, Any]], group_name: str,
+                        message_id: Optional[str] = None):
+        """Queue a message for every client in the group.
+
+        message_id keeps an encoded message replayable; without it only
+        dict messages, whose id can be read off, enter the replay buffer.
+        """
+        # Serialized once, whatever the group size
+        if isinstance(message, str):
+            payload = message
+        else:
+            payload = json.dumps(message)
+            message_id = message_id or message.get('id')
+        if message_id:
+            self.replay.append(group_name, message_id, payload)
+        if group_name not in self.active_connections:
+            return
+        for connection in list(self.active_connections[group_name].values()):
+            try:
+                connection.queue.put_nowait(payload)
+            except asyncio.QueueFull:
+                self.disconnect(connection.websocket, group_name)
+                task = asyncio.create_task(self._close(connection.websocket, SLOW_CLIENT_CLOSE_CODE))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+
+    def _remove(self, websocket: WebSocket, group_name: str):
+        connections = self.active_connections.get(group_name)
+        if connections is None:
+            return None
+        connection = connections.pop(websocket, None)
+        if not connections:
+            del self.active_connections[group_name]
+        return connection
+
+    async def _replayed(self, group_name: str, last_id: str, buffered: List[tuple]) -> List[str]:
+        payloads = ReplayBuffer.after(buffered, last_id)
+        if payloads is not None or self.history is None:
+            return payloads or []
+        messages = await self.history(group_name, last_id, self.replay_limit)
+        if messages is None:
+            # Unknown id: nothing to go on, the client reloads its history instead
+            return []
+        payloads = [dumps(message) for message in messages]
+        # Buffered messages newer than the last persisted one are still in the write-behind queue
+        newer = ReplayBuffer.after(buffered, messages[-1].get('id')) if messages else None
+        if newer is None:
+            loaded = {message.get('id') for message in messages}
+            newer = [payload for message_id, payload in buffered if message_id not in loaded]
+        return (payloads + newer)[-self.replay_limit:]
+
+    async def _sender(self, connection: Connection, group_name: str,
+                      last_id: Optional[str] = None, buffered: Optional[List[tuple]] = None):
+        try:
+            if last_id:
+                for payload in await self._replayed(group_name, last_id, buffered):
+                    await asyncio.wait_for(connection.websocket.send_text(payload), self.send_timeout)
+            while True:
+                payload = await connection.queue.get()
+                await asyncio.wait_for(connection.websocket.send_text(payload), self.send_timeout)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # Dead or stalled socket: stop delivering to it
+            self.disconnect(connection.websocket, group_name)
+            await self._close(connection.websocket)
+
+    async def _close(self, websocket: WebSocket, code: int = 1000):
+        try:
+            await asyncio.wait_for(websocket.close(code=code), self.send_timeout)
+        except Exception:
+            pass
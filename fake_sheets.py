@@ -0,0 +1,106 @@
+import re
+from collections import Counter
+from typing import Dict, List, Optional
+
+# Header rows of the sheets the app expects to find in the spreadsheet
+DEFAULT_SHEETS = {
+    'Questionnaire': [['email', 'hobbies', 'topics', 'gender', 'year', 'purpose']],
+    'Messages': [['id', 'group_name', 'email', 'message', 'timestamp']],
+    'Groups': [['id', 'group_name', 'email']],
+}
+
+_RANGE = re.compile(r'^(?P<sheet>[^!]+)!(?P<start_col>[A-Z]+)(?P<start_row>\d*):(?P<end_col>[A-Z]+)(?P<end_row>\d*)$')
+
+
+def column_index(letters: str) -> int:
+    index = 0
+    for letter in letters:
+        index = index * 26 + ord(letter) - ord('A') + 1
+    return index - 1
+
+
+def column_letters(index: int) -> str:
+    letters = ''
+    index += 1
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(ord('A') + remainder) + letters
+    return letters
+
+
+def parse_range(range_name: str):
+    """'Messages!A5:E' -> ('Messages', first column, last column, first row, last row or None), 0-based"""
+    match = _RANGE.match(range_name)
+    if match is None:
+        raise ValueError(f"Unsupported range '{range_name}'")
+    start_row = int(match['start_row'] or 1) - 1
+    end_row = int(match['end_row']) if match['end_row'] else None
+    return match['sheet'], column_index(match['start_col']), column_index(match['end_col']), start_row, end_row
+
+
+class FakeRequest:
+    def __init__(self, call):
+        self.call = call
+
+    def execute(self):
+        return self.call()
+
+
+class FakeValues:
+    def __init__(self, sheets: 'FakeSheets'):
+        self.sheets = sheets
+
+    def get(self, spreadsheetId: str, range: str):
+        return FakeRequest(lambda: self.sheets.get(range))
+
+    def append(self, spreadsheetId: str, range: str, valueInputOption: str, body: dict):
+        return FakeRequest(lambda: self.sheets.append(range, body['values']))
+
+
+class FakeSheets:
+    """In-memory stand-in for the spreadsheets() resource of the Sheets API.
+
+    Supports the values().get and values().append calls SheetsService makes,
+    with A1 ranges such as 'Messages!A:E' or 'Messages!A42:E', and counts
+    requests per method so quota usage can be checked offline:
+
+        sheets_service = SheetsService(sheet=FakeSheets())
+    """
+
+    def __init__(self, sheets: Optional[Dict[str, List[List]]] = None):
+        sheets = DEFAULT_SHEETS if sheets is None else sheets
+        self.data: Dict[str, List[List[str]]] = {
+            name: [[str(value) for value in row] for row in rows] for name, rows in sheets.items()
+        }
+        self.requests = Counter()
+
+    def values(self) -> FakeValues:
+        return FakeValues(self)
+
+    def get(self, range_name: str) -> dict:
+        self.requests['get'] += 1
+        sheet, first_col, last_col, first_row, last_row = parse_range(range_name)
+        rows = self.data.get(sheet, [])[first_row:last_row]
+        values = [row[first_col:last_col + 1] for row in rows]
+        # Like the real API, trailing empty rows and an empty result are omitted
+        while values and not values[-1]:
+            values.pop()
+        result = {'range': range_name}
+        if values:
+            result['values'] = values
+        return result
+
+    def append(self, range_name: str, values: List[List]) -> dict:
+        self.requests['append'] += 1
+        sheet, first_col, last_col, _, _ = parse_range(range_name)
+        rows = self.data.setdefault(sheet, [])
+        start = len(rows) + 1
+        for row in values:
+            rows.append([''] * first_col + [str(value) for value in row])
+        return {
+            'updates': {
+                'updatedRange': f'{sheet}!{column_letters(first_col)}{start}:'
+                                f'{column_letters(last_col)}{start + len(values) - 1}',
+                'updatedRows': len(values),
+            }
+        }
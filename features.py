@@ -0,0 +1,173 @@
+import numpy as np
+from scipy import sparse
+from typing import Dict, Iterable, List, Tuple
+
+MULTI_LABEL_FIELDS = ('hobbies', 'topics')
+CATEGORICAL_FIELDS = ('gender', 'year')
+FEATURE_FIELDS = MULTI_LABEL_FIELDS + CATEGORICAL_FIELDS
+
+
+def split_answer(value) -> Tuple[str, ...]:
+    """Split a comma-joined questionnaire answer into its stripped, non-empty items"""
+    if not isinstance(value, str):
+        return ()
+    return tuple(sorted({item.strip() for item in value.split(',')} - {''}))
+
+
+def category_token(value) -> Tuple[str, ...]:
+    """Single-item token tuple for a one-hot field, empty when the answer is missing"""
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return ()
+    value = str(value).strip()
+    return (value,) if value else ()
+
+
+class FeatureEncoder:
+    """Encodes questionnaire rows as a sparse binary CSR matrix.
+
+    Behaves like a MultiLabelBinarizer for hobbies and topics plus a one-hot
+    encoder for gender and year. Columns are laid out in blocks
+    ``[hobbies | topics | gender | year]`` and every block uses a sorted
+    vocabulary, so the same answers always map to the same columns no matter
+    the row order. Items not seen during ``fit`` are ignored by ``transform``.
+    """
+
+    def __init__(self):
+        self.vocabulary_: Dict[str, Dict[str, int]] = {field: {} for field in FEATURE_FIELDS}
+        self._reset_partial()
+
+    def _reset_partial(self):
+        # Per-field token ids in first-seen order plus the encoded chunks, for partial_fit
+        self._seen: Dict[str, Dict[str, int]] = {field: {} for field in FEATURE_FIELDS}
+        self._chunks: Dict[str, list] = {field: [] for field in FEATURE_FIELDS}
+
+    @staticmethod
+    def tokenize(rows: Iterable[dict]) -> List[Tuple[Tuple[str, ...], ...]]:
+        """Tokenize each row once into one token tuple per feature field"""
+        tokenized = []
+        for row in rows:
+            tokenized.append(
+                tuple(split_answer(row.get(field)) for field in MULTI_LABEL_FIELDS)
+                + tuple(category_token(row.get(field)) for field in CATEGORICAL_FIELDS)
+            )
+        return tokenized
+
+    def fit_tokens(self, tokenized):
+        seen = {field: set() for field in FEATURE_FIELDS}
+        for row in tokenized:
+            for field, tokens in zip(FEATURE_FIELDS, row):
+                seen[field].update(tokens)
+        self.vocabulary_ = {
+            field: {token: i for i, token in enumerate(sorted(seen[field]))}
+            for field in FEATURE_FIELDS
+        }
+        return self
+
+    def transform_tokens(self, tokenized) -> sparse.csr_matrix:
+        offsets = [self.field_slice(field).start for field in FEATURE_FIELDS]
+        vocabularies = [self.vocabulary_[field] for field in FEATURE_FIELDS]
+        indptr = [0]
+        indices = []
+        for row in tokenized:
+            for offset, vocabulary, tokens in zip(offsets, vocabularies, row):
+                indices.extend(sorted(offset + vocabulary[t] for t in tokens if t in vocabulary))
+            indptr.append(len(indices))
+        data = np.ones(len(indices), dtype=np.float64)
+        return sparse.csr_matrix(
+            (data, np.asarray(indices, dtype=np.int32), np.asarray(indptr, dtype=np.int64)),
+            shape=(len(tokenized), self.n_features),
+        )
+
+    def covers_tokens(self, tokenized) -> bool:
+        """Whether every token is in the vocabulary, so transform_tokens drops nothing"""
+        vocabularies = [self.vocabulary_[field] for field in FEATURE_FIELDS]
+        return all(
+            token in vocabulary
+            for row in tokenized
+            for vocabulary, tokens in zip(vocabularies, row)
+            for token in tokens
+        )
+
+    def fit(self, df):
+        return self.fit_tokens(self.tokenize(_records(df)))
+
+    def transform(self, df) -> sparse.csr_matrix:
+        return self.transform_tokens(self.tokenize(_records(df)))
+
+    def fit_transform(self, df) -> sparse.csr_matrix:
+        tokenized = self.tokenize(_records(df))
+        return self.fit_tokens(tokenized).transform_tokens(tokenized)
+
+    def partial_fit(self, rows: Iterable[dict]):
+        """Tokenize and encode one chunk of rows; call finalize() after the last chunk.
+
+        Only the token ids of each chunk are kept, so memory grows with the
+        number of answers rather than with the raw rows.
+        """
+        tokenized = self.tokenize(_records(rows))
+        for position, field in enumerate(FEATURE_FIELDS):
+            seen = self._seen[field]
+            lengths = np.fromiter((len(row[position]) for row in tokenized), dtype=np.int64, count=len(tokenized))
+            ids = [seen.setdefault(token, len(seen)) for row in tokenized for token in row[position]]
+            self._chunks[field].append((np.asarray(ids, dtype=np.int32), lengths))
+        return self
+
+    def finalize(self) -> sparse.csr_matrix:
+        """Fix the sorted vocabulary from every chunk seen so far and return the full matrix"""
+        blocks = []
+        for field in FEATURE_FIELDS:
+            seen = self._seen[field]
+            tokens = sorted(seen)
+            self.vocabulary_[field] = {token: i for i, token in enumerate(tokens)}
+            remap = np.empty(len(seen), dtype=np.int32)
+            for token, old_id in seen.items():
+                remap[old_id] = self.vocabulary_[field][token]
+            chunks = self._chunks[field]
+            ids = np.concatenate([c[0] for c in chunks]) if chunks else np.empty(0, dtype=np.int32)
+            lengths = np.concatenate([c[1] for c in chunks]) if chunks else np.empty(0, dtype=np.int64)
+            indptr = np.concatenate([[0], np.cumsum(lengths)])
+            block = sparse.csr_matrix(
+                (np.ones(len(ids), dtype=np.float64), remap[ids], indptr),
+                shape=(len(lengths), len(tokens)),
+            )
+            block.sort_indices()
+            blocks.append(block)
+        self._reset_partial()
+        return sparse.hstack(blocks, format='csr')
+
+    @property
+    def n_features(self) -> int:
+        return sum(len(self.vocabulary_[field]) for field in FEATURE_FIELDS)
+
+    def field_slice(self, field: str) -> slice:
+        start = 0
+        for name in FEATURE_FIELDS:
+            size = len(self.vocabulary_[name])
+            if name == field:
+                return slice(start, start + size)
+            start += size
+        raise KeyError(field)
+
+    def categories(self, features, field: str) -> np.ndarray:
+        """Decode a one-hot field back to its category per row ('' when the answer was missing)"""
+        vocabulary = self.vocabulary_[field]
+        names = np.array([''] + sorted(vocabulary, key=vocabulary.get), dtype=object)
+        block = sparse.csr_matrix(features[:, self.field_slice(field)])
+        present = np.diff(block.indptr) > 0
+        codes = np.zeros(block.shape[0], dtype=np.int64)
+        codes[present] = np.asarray(block[present].argmax(axis=1)).ravel() + 1
+        return names[codes]
+
+    def feature_names(self) -> List[str]:
+        return [
+            f'{field}={token}'
+            for field in FEATURE_FIELDS
+            for token in sorted(self.vocabulary_[field], key=self.vocabulary_[field].get)
+        ]
+
+
+def _records(df) -> Iterable[dict]:
+    if hasattr(df, 'to_dict'):
+        columns = [field for field in FEATURE_FIELDS if field in df.columns]
+        return df[columns].to_dict('records')
+    return df
@@ -0,0 +1,124 @@
+import os
+import numpy as np
+from typing import Any, Dict, List, Optional
+from features import FeatureEncoder
+from database import db_service
+from pickle_store import SharedPickle
+
+GROUP_MODEL_PATH = os.getenv("GROUP_MODEL_PATH", "group_model.pickle")
+# A full rebalance is requested once incremental placements are this much worse
+# than the fitted groups on average, or once this share of users joined incrementally.
+REBALANCE_DRIFT_RATIO = float(os.getenv("REBALANCE_DRIFT_RATIO", "1.5"))
+REBALANCE_MAX_NEW_FRACTION = float(os.getenv("REBALANCE_MAX_NEW_FRACTION", "0.2"))
+# Groups tried per submission before it counts as unplaced
+MAX_PLACEMENT_ATTEMPTS = 5
+
+
+class GroupModel:
+    """Centroids of the current groups, used to place new submissions without reclustering.
+
+    Every worker holds its own copy, so sizes only count the members this
+    copy knows about; the database has the final say on whether a group is full.
+    """
+
+    def __init__(self, encoder: FeatureEncoder, groups: List[Dict[str, Any]], sums, sizes,
+                 baseline_distance: float, min_size: int = 4, max_size: int = 6):
+        self.encoder = encoder
+        self.groups = [{'id': g['id'], 'group_name': g['group_name']} for g in groups]
+        self.sums = sums
+        self.sizes = sizes
+        self.baseline_distance = baseline_distance
+        self.min_size = min_size
+        self.max_size = max_size
+        # Groups the database reported full or replaced
+        self.full = set()
+        self.fitted_members = 0
+        self.added = 0
+        self.added_distance = 0.0
+        self.unplaced = 0
+
+    @classmethod
+    def fit(cls, encoder: FeatureEncoder, features, emails: List[str], groups: List[Dict[str, Any]],
+            min_size: int = 4, max_size: int = 6) -> 'GroupModel':
+        row_of = {email: row for row, email in enumerate(emails)}
+        labels = np.full(len(emails), -1, dtype=np.int64)
+        for index, group in enumerate(groups):
+            rows = [row_of[email] for email in group['email'].split(',') if email in row_of]
+            labels[rows] = index
+        assigned = np.flatnonzero(labels >= 0)
+
+        sums = np.zeros((len(groups), features.shape[1]), dtype=np.float64)
+        np.add.at(sums, labels[assigned], features[assigned].toarray())
+        sizes = np.bincount(labels[assigned], minlength=len(groups)).astype(np.int64)
+        centroids = sums / np.maximum(sizes, 1)[:, None]
+        offsets = features[assigned].toarray() - centroids[labels[assigned]]
+        baseline = float(np.sqrt((offsets ** 2).sum(axis=1)).mean()) if len(assigned) else 0.0
+
+        model = cls(encoder, groups, sums, sizes, baseline, min_size, max_size)
+        model.fitted_members = len(assigned)
+        return model
+
+    def rank(self, data: Dict[str, Any]):
+        """The submission's vector, and the groups that may have room with their distances, closest first"""
+        vector = self.encoder.transform([data]).toarray()[0]
+        distances = np.sqrt(((self.sums / np.maximum(self.sizes, 1)[:, None] - vector) ** 2).sum(axis=1))
+        distances[self.sizes >= self.max_size] = np.inf
+        distances[list(self.full)] = np.inf
+        order = np.argsort(distances, kind='stable')
+        order = order[np.isfinite(distances[order])]
+        return vector, order, distances[order]
+
+    def place(self, vector, index: int, distance: float) -> Dict[str, Any]:
+        self.sums[index] += vector
+        self.sizes[index] += 1
+        self.added += 1
+        self.added_distance += float(distance)
+        return self.groups[index]
+
+    def needs_rebalance(self) -> bool:
+        if self.unplaced:
+            return True
+        if self.added > REBALANCE_MAX_NEW_FRACTION * max(self.fitted_members, 1):
+            return True
+        return self.added > 0 and self.added_distance / self.added > REBALANCE_DRIFT_RATIO * self.baseline_distance
+
+
+_group_model = SharedPickle(GROUP_MODEL_PATH)
+
+
+def set_group_model(model: GroupModel):
+    _group_model.set(model)
+
+
+def get_group_model() -> Optional[GroupModel]:
+    """The current model, reloaded when another process (e.g. the scheduled job) wrote a newer one"""
+    return _group_model.get()
+
+
+async def assign_submission(data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Add a freshly submitted questionnaire to its best existing group that has room.
+
+    Users already in a current group stay where they are. Otherwise the
+    closest groups are tried in turn, and the database refuses any that
+    other workers have filled in the meantime.
+    """
+    model = get_group_model()
+    if model is None or not model.groups:
+        return None
+    email = data['email']
+    current = await db_service.get_group_for_member(email)
+    if current is not None:
+        return current
+    vector, order, distances = model.rank(data)
+    for index, distance in zip(order[:MAX_PLACEMENT_ATTEMPTS], distances):
+        index = int(index)
+        if await db_service.add_group_member(model.groups[index]['id'], email, model.max_size):
+            return model.place(vector, index, distance)
+        model.full.add(index)
+    model.unplaced += 1
+    return None
+
+
+def needs_rebalance() -> bool:
+    model = get_group_model()
+    return model is not None and model.needs_rebalance()
@@ -1,15 +1,26 @@
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Request, Depends
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Request, Depends, Query
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import HTMLResponse, RedirectResponse
 from fastapi.templating import Jinja2Templates
-import json
-import uuid
-from database import db_service
+import tempfile
+from datetime import datetime
+from typing import Optional
+from database import MESSAGE_PAGE_SIZE, db_service, is_transient_error
+from incremental import assign_submission, needs_rebalance
+from suggestions import SUGGESTIONS_K, add_submission, get_suggestion_index
+from message_writer import MessageWriter
+from connection_manager import ConnectionManager
+from broadcast_backend import get_broadcast_backend
+from message_codec import MessageError, decode_frame
+from clustering_jobs import ClusteringJobs
+from questionnaire_import import FORMATS, format_from_content_type, import_questionnaires, read_lines
 import asyncio
 
 app = FastAPI()
 
+MAX_MESSAGE_PAGE_SIZE = 200
+
 # Mount static files
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
@@ -26,32 +37,35 @@ app.add_middleware(
 )
 
 # Store active WebSocket connections
-class ConnectionManager:
-    def __init__(self):
-        self.active_connections: dict = {}
-
-    async def connect(self, websocket: WebSocket, group_name: str):
-        await websocket.accept()
-        if group_name not in self.active_connections:
-            self.active_connections[group_name] = []
-        self.active_connections[group_name].append(websocket)
-
-    def disconnect(self, websocket: WebSocket, group_name: str):
-        if group_name in self.active_connections:
-            self.active_connections[group_name].remove(websocket)
-            if not self.active_connections[group_name]:
-                del self.active_connections[group_name]
-
-    async def broadcast(self, message: str, group_name: str):
-        if group_name in self.active_connections:
-            for connection in self.active_connections[group_name]:
-                await connection.send_text(message)
-
-manager = ConnectionManager()
+manager = ConnectionManager(history=db_service.get_messages_after)
+message_writer = MessageWriter(db_service.save_messages, is_retryable=is_transient_error)
+# Carries messages between workers; each worker fans them out to its own sockets
+broadcast_backend = get_broadcast_backend()
+# The job saves groups from another process, so this process's cached groups are dropped when it ends
+clustering_jobs = ClusteringJobs(on_finished=lambda job: db_service.cache.invalidate('groups'))
 
 @app.on_event("startup")
 async def startup_event():
     await db_service.init_db()
+    message_writer.start()
+    await broadcast_backend.start(manager.broadcast)
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await broadcast_backend.stop()
+    await message_writer.stop()
+    clustering_jobs.shutdown()
+
+@app.get("/healthz/db")
+async def database_health():
+    try:
+        return await db_service.pool_status()
+    except Exception as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+@app.get("/healthz/cache")
+async def cache_stats():
+    return db_service.cache.stats()
 
 @app.get("/", response_class=HTMLResponse)
 async def read_root(request: Request):
@@ -73,10 +87,53 @@ async def groups_page(request: Request):
 async def submit_questionnaire(data: dict):
     try:
         await db_service.save_questionnaire(data)
-        return {"status": "success"}
+        group = await assign_submission(data)
+        add_submission(data)
+        if needs_rebalance():
+            clustering_jobs.submit('rebalance')
+        return {"status": "success", "group": group['group_name'] if group else None}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/import-questionnaires")
+async def import_questionnaires_file(request: Request, format: Optional[str] = None):
+    """Bulk upsert from a CSV or NDJSON request body, e.g. curl --data-binary @cohort.csv -H 'Content-Type: text/csv'"""
+    format = format or format_from_content_type(request.headers.get("content-type"))
+    if format not in FORMATS:
+        raise HTTPException(status_code=415, detail=f"Send text/csv or application/x-ndjson, or pass ?format= ({', '.join(FORMATS)})")
+    # Spooled to disk so the upload is never held in memory whole
+    with tempfile.TemporaryFile() as upload:
+        async for chunk in request.stream():
+            upload.write(chunk)
+        upload.seek(0)
+        try:
+            result = await import_questionnaires(read_lines(upload), format)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+    if result["inserted"] or result["updated"]:
+        # Imported users have no group until the next recluster
+        clustering_jobs.submit('import')
+    return result
+
+@app.get("/suggestions/{email}")
+async def get_suggestions(email: str, k: int = Query(SUGGESTIONS_K, ge=1, le=max(SUGGESTIONS_K, 1))):
+    index = get_suggestion_index()
+    if index is None:
+        raise HTTPException(status_code=503, detail="Suggestions are not available until clustering has run")
+    suggestions = index.suggest(email, k)
+    if suggestions is None:
+        # Submitted through another worker since the index was built
+        try:
+            rows = await db_service.get_questionnaires([email])
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+        if not rows:
+            raise HTTPException(status_code=404, detail="Questionnaire not found")
+        suggestions = index.query(rows[0], k)
+    return {"email": email, "suggestions": suggestions}
+
 @app.get("/get-questionnaire-data")
 async def get_questionnaire_data():
     try:
@@ -86,16 +143,24 @@ async def get_questionnaire_data():
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.websocket("/ws/{group_name}")
-async def websocket_endpoint(websocket: WebSocket, group_name: str):
-    await manager.connect(websocket, group_name)
+async def websocket_endpoint(websocket: WebSocket, group_name: str, last_id: Optional[str] = None):
+    # last_id: the last message a reconnecting client saw; everything after it is replayed first
+    await manager.connect(websocket, group_name, last_id)
     try:
         while True:
             data = await websocket.receive_text()
-            message_data = json.loads(data)
-            message_data["id"] = str(uuid.uuid4())
-            await db_service.save_message(message_data)
-            await manager.broadcast(data, group_name)
+            try:
+                message = decode_frame(data, group_name)
+                await broadcast_backend.publish(group_name, message.payload, message.record["id"])
+            except MessageError as e:
+                print(f"Dropping invalid message for {group_name}: {str(e)}")
+                continue
+            # Persisted in batches by the write-behind queue
+            await message_writer.put(message.record)
     except WebSocketDisconnect:
+        pass
+    finally:
+        # Whatever ended the loop, the socket must leave its group
         manager.disconnect(websocket, group_name)
 
 @app.post("/save-groups")
@@ -114,20 +179,52 @@ async def get_groups():
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/my-group/{email}")
+async def get_my_group(email: str):
+    try:
+        group = await db_service.get_group_for_member(email)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    if group is None:
+        raise HTTPException(status_code=404, detail="No group found for this email")
+    return group
+
 @app.get("/get-messages/{group_name}")
-async def get_messages(group_name: str):
+async def get_messages(group_name: str, before: Optional[str] = None,
+                       limit: int = Query(MESSAGE_PAGE_SIZE, ge=1, le=MAX_MESSAGE_PAGE_SIZE)):
+    # before is the "<timestamp>,<id>" cursor returned as next_before by the previous page
+    cursor = None
+    if before:
+        try:
+            timestamp, message_id = before.split(",", 1)
+            cursor = (datetime.fromisoformat(timestamp), message_id)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="before must look like <timestamp>,<id>")
     try:
-        messages = await db_service.get_messages(group_name)
-        return messages
+        messages, next_before = await db_service.get_messages(group_name, cursor, limit)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    return {
+        "messages": messages,
+        "next_before": f"{next_before[0].isoformat()},{next_before[1]}" if next_before else None,
+    }
 
 # Route to manually trigger clustering
-@app.get("/run-clustering")
-async def trigger_clustering():
-    from clustering import run_clustering
+@app.get("/run-clustering", status_code=202)
+async def trigger_clustering(force: bool = False):
     try:
-        await run_clustering()
-        return {"status": "success", "message": "Clustering completed successfully"}
+        job, created = clustering_jobs.submit('manual', force)
+        return {
+            "status": "accepted" if created else "already_running",
+            "job_id": job.id,
+            "status_url": f"/clustering-jobs/{job.id}",
+        }
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e)) 
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/clustering-jobs/{job_id}")
+async def get_clustering_job(job_id: str):
+    job = clustering_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Clustering job not found")
+    return job.to_dict() 
\ No newline at end of file
@@ -0,0 +1,90 @@
+import json
+import os
+import uuid
+from datetime import datetime
+from typing import Any, Dict, NamedTuple, Union
+
+try:
+    import orjson
+except ImportError:
+    # Optional; the standard library json is used without it
+    orjson = None
+
+MAX_MESSAGE_LENGTH = int(os.getenv("MAX_MESSAGE_LENGTH", "4000"))
+MAX_EMAIL_LENGTH = 320
+# Encoded size limit, whatever the characters: Postgres NOTIFY payloads must
+# stay under 8000 bytes, including the broadcast envelope around the message
+MAX_PAYLOAD_BYTES = int(os.getenv("MAX_PAYLOAD_BYTES", "7000"))
+
+
+class MessageError(ValueError):
+    """A chat frame that is not valid JSON or does not match the message schema"""
+
+
+class ChatMessage(NamedTuple):
+    """A validated message: the row to persist and the JSON sent to clients.
+
+    payload is encoded once and shared by every recipient and by the
+    broadcast backend.
+    """
+    record: Dict[str, Any]
+    payload: str
+
+
+def loads(data: Union[str, bytes]) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(value: Any) -> str:
+    if orjson is not None:
+        return orjson.dumps(value).decode()
+    return json.dumps(value, default=_default, separators=(',', ':'))
+
+
+def _default(value: Any) -> Any:
+    if isinstance(value, datetime):
+        # Same format orjson uses for naive datetimes
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def new_message(group_name: str, email: Any, message: Any) -> ChatMessage:
+    """Validate one message, stamp its id and timestamp, and encode it"""
+    if not isinstance(email, str) or not email or len(email) > MAX_EMAIL_LENGTH:
+        raise MessageError("email must be a non-empty string")
+    if not isinstance(message, str) or not message.strip():
+        raise MessageError("message must be a non-empty string")
+    if len(message) > MAX_MESSAGE_LENGTH:
+        raise MessageError(f"message is longer than {MAX_MESSAGE_LENGTH} characters")
+    # Postgres text cannot hold NUL characters
+    if '\x00' in email or '\x00' in message or '\x00' in group_name:
+        raise MessageError("message contains a NUL character")
+    record = {
+        "id": str(uuid.uuid4()),
+        "group_name": group_name,
+        "email": email,
+        "message": message,
+        "timestamp": datetime.now(),
+    }
+    payload = dumps(record)
+    # A character is at most 4 bytes, so most payloads need no encoding to check
+    if len(payload) * 4 > MAX_PAYLOAD_BYTES and len(payload.encode()) > MAX_PAYLOAD_BYTES:
+        raise MessageError(f"message is larger than {MAX_PAYLOAD_BYTES} bytes encoded")
+    return ChatMessage(record, payload)
+
+
+def decode_frame(frame: Union[str, bytes], group_name: str) -> ChatMessage:
+    """Parse a client frame such as {"email": ..., "message": ...}.
+
+    The group always comes from the WebSocket path, and any other fields
+    the client sends are dropped.
+    """
+    try:
+        data = loads(frame)
+    except ValueError:
+        raise MessageError("frame is not valid JSON")
+    if not isinstance(data, dict):
+        raise MessageError("frame must be a JSON object")
+    return new_message(group_name, data.get("email"), data.get("message"))
@@ -0,0 +1,113 @@
+import asyncio
+import os
+from typing import Any, Awaitable, Callable, Dict, List
+
+MESSAGE_BATCH_SIZE = int(os.getenv("MESSAGE_BATCH_SIZE", "200"))
+MESSAGE_FLUSH_INTERVAL_MS = int(os.getenv("MESSAGE_FLUSH_INTERVAL_MS", "50"))
+# Messages waiting to be written; once full, senders wait for the database to catch up
+MESSAGE_QUEUE_SIZE = int(os.getenv("MESSAGE_QUEUE_SIZE", "10000"))
+MAX_RETRY_DELAY = 5.0
+
+_STOP = object()
+
+
+class MessageWriter:
+    """Write-behind buffer that persists chat messages in batches.
+
+    Messages are flushed with one multi-row insert whenever batch_size have
+    queued up or flush_interval_ms has passed since the first one arrived.
+    The queue is bounded, so put() waits when the database falls behind.
+    Flushes that fail with a retryable error are retried with exponential
+    backoff. Any other error is split down to the rows that cause it, which
+    are dropped, so one bad message cannot hold up the ones behind it.
+    """
+
+    def __init__(self, save_batch: Callable[[List[Dict[str, Any]]], Awaitable[None]],
+                 batch_size: int = MESSAGE_BATCH_SIZE,
+                 flush_interval_ms: int = MESSAGE_FLUSH_INTERVAL_MS,
+                 max_pending: int = MESSAGE_QUEUE_SIZE,
+                 max_retry_delay: float = MAX_RETRY_DELAY,
+                 is_retryable: Callable[[Exception], bool] = lambda error: True):
+        self.save_batch = save_batch
+        self.is_retryable = is_retryable
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval_ms / 1000
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_pending)
+        self.max_retry_delay = max_retry_delay
+        self.task = None
+        self.written = 0
+        self.dropped = 0
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+
+    async def put(self, message: Dict[str, Any]):
+        await self.queue.put(message)
+
+    async def stop(self, timeout: float = 10.0):
+        """Flush everything queued so far, then stop the background task"""
+        if self.task is None:
+            return
+        try:
+            # The queue may be full and the database down, so queuing _STOP counts against the timeout too
+            await asyncio.wait_for(self._drain(), timeout)
+        except asyncio.TimeoutError:
+            self.task.cancel()
+            print(f"Message writer did not drain in {timeout}s, {self.queue.qsize()} messages not saved")
+        self.task = None
+
+    async def _drain(self):
+        await self.queue.put(_STOP)
+        await self.task
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await self.queue.get()
+            if item is _STOP:
+                break
+            batch = [item]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    item = self.queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self.queue.get(), remaining)
+                    except asyncio.TimeoutError:
+                        break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._flush(batch)
+
+    async def _flush(self, batch: List[Dict[str, Any]]):
+        delay = 0.1
+        while True:
+            try:
+                await self.save_batch(batch)
+                self.written += len(batch)
+                return
+            except Exception as e:
+                if not self.is_retryable(e):
+                    await self._split(batch, e)
+                    return
+                print(f"Error saving {len(batch)} messages, retrying in {delay:.1f}s: {str(e)}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.max_retry_delay)
+
+    async def _split(self, batch: List[Dict[str, Any]], error: Exception):
+        """Save both halves of a batch that failed for good, until the failing rows are isolated"""
+        if len(batch) == 1:
+            print(f"Dropping message {batch[0].get('id')} that cannot be saved: {str(error)}")
+            self.dropped += 1
+            return
+        middle = len(batch) // 2
+        await self._flush(batch[:middle])
+        await self._flush(batch[middle:])
@@ -0,0 +1,46 @@
+import os
+import pickle
+from typing import Any, Optional
+
+
+def save_pickle(value: Any, path: str):
+    """Pickle value to path through a temporary file, so readers see the old file or the complete new one"""
+    # Per process, so two writers of the same path cannot interleave in one temporary file
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(value, f)
+    os.replace(tmp_path, path)
+
+
+def load_pickle(path: str) -> Any:
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+class SharedPickle:
+    """An object shared between processes through a pickle file.
+
+    set() saves a new version; get() returns the version in memory,
+    reloading it first when another process (e.g. the clustering job)
+    wrote a newer file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.value = None
+        self.mtime: Optional[float] = None
+
+    def set(self, value: Any):
+        save_pickle(value, self.path)
+        self.value = value
+        self.mtime = os.path.getmtime(self.path)
+
+    def get(self) -> Any:
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return self.value
+        if mtime != self.mtime:
+            self.value = load_pickle(self.path)
+            self.mtime = mtime
+        return self.value
@@ -0,0 +1,166 @@
+"""Bulk questionnaire import from CSV or NDJSON.
+
+    python questionnaire_import.py cohort.csv [--format csv|ndjson] [--batch-size 5000]
+
+Reads the file a batch at a time, validates each batch and streams it to
+DatabaseService.import_questionnaires, which COPYs it into a staging table
+and upserts it into questionnaire by email. Memory stays flat whatever the
+file size. Invalid rows are skipped and reported with their line numbers.
+"""
+import argparse
+import asyncio
+import codecs
+import csv
+import os
+import sys
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+from database import QUESTIONNAIRE_COLUMNS, db_service
+from message_codec import loads
+
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "5000"))
+# Invalid rows listed in the result; the rest are only counted
+IMPORT_MAX_ERRORS = int(os.getenv("IMPORT_MAX_ERRORS", "100"))
+MAX_EMAIL_LENGTH = 320
+FORMATS = ('csv', 'ndjson')
+CONTENT_TYPES = {
+    'text/csv': 'csv',
+    'application/csv': 'csv',
+    'application/x-ndjson': 'ndjson',
+    'application/ndjson': 'ndjson',
+    'application/jsonl': 'ndjson',
+}
+
+
+class ImportRowError(ValueError):
+    """A row that cannot be imported"""
+
+
+def format_from_content_type(content_type: Optional[str]) -> Optional[str]:
+    return CONTENT_TYPES.get((content_type or '').split(';')[0].strip().lower())
+
+
+def format_from_path(path: str) -> Optional[str]:
+    extension = os.path.splitext(path)[1].lower()
+    return {'.csv': 'csv', '.ndjson': 'ndjson', '.jsonl': 'ndjson'}.get(extension)
+
+
+def read_rows(lines: Iterable[str], format: str) -> Iterator[Tuple[int, Any]]:
+    """(line number, raw row) pairs; CSV rows are dicts keyed by the header"""
+    if format == 'csv':
+        reader = csv.DictReader(lines)
+        try:
+            for row in reader:
+                # line_num is the last physical line of the record, which may span several
+                yield reader.line_num, row
+        except csv.Error as e:
+            raise ValueError(f"line {reader.line_num}: {str(e)}")
+    elif format == 'ndjson':
+        for line_number, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            try:
+                yield line_number, loads(line)
+            except ValueError:
+                yield line_number, ImportRowError("line is not valid JSON")
+    else:
+        raise ValueError(f"Unknown format '{format}', expected one of: {', '.join(FORMATS)}")
+
+
+def _answer(value: Any) -> Optional[str]:
+    if value is None:
+        return None
+    if isinstance(value, list):
+        # NDJSON may give multi-choice answers as arrays
+        if not all(isinstance(item, str) for item in value):
+            raise ImportRowError("list answers must contain strings")
+        value = ','.join(value)
+    elif isinstance(value, (dict, bool)):
+        raise ImportRowError("answers must be strings")
+    value = str(value).strip()
+    return value or None
+
+
+def validate_row(row: Any) -> Tuple[Any, ...]:
+    """The row as a tuple in QUESTIONNAIRE_COLUMNS order"""
+    if isinstance(row, ImportRowError):
+        raise row
+    if not isinstance(row, dict):
+        raise ImportRowError("row must be an object")
+    email = row.get('email')
+    if not isinstance(email, str) or not email.strip():
+        raise ImportRowError("email is required")
+    email = email.strip()
+    if len(email) > MAX_EMAIL_LENGTH or '@' not in email:
+        raise ImportRowError("email is not a valid address")
+    return (email,) + tuple(_answer(row.get(column)) for column in QUESTIONNAIRE_COLUMNS[1:])
+
+
+class ImportBatches:
+    """Iterates over validated batches of (line, *QUESTIONNAIRE_COLUMNS) records.
+
+    Counts and keeps the first max_errors invalid rows along the way.
+    """
+
+    def __init__(self, lines: Iterable[str], format: str, batch_size: int = IMPORT_BATCH_SIZE,
+                 max_errors: int = IMPORT_MAX_ERRORS):
+        self.rows = read_rows(lines, format)
+        self.batch_size = batch_size
+        self.max_errors = max_errors
+        self.read = 0
+        self.invalid = 0
+        self.errors: List[Dict[str, Any]] = []
+
+    def __iter__(self) -> Iterator[List[Tuple[Any, ...]]]:
+        batch = []
+        for line, row in self.rows:
+            self.read += 1
+            try:
+                batch.append((line,) + validate_row(row))
+            except ImportRowError as e:
+                self.invalid += 1
+                if len(self.errors) < self.max_errors:
+                    self.errors.append({'line': line, 'error': str(e)})
+                continue
+            if len(batch) >= self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+
+async def import_questionnaires(lines: Iterable[str], format: str,
+                                batch_size: int = IMPORT_BATCH_SIZE) -> Dict[str, Any]:
+    """Import questionnaire rows from CSV or NDJSON lines; returns the counts and invalid rows"""
+    batches = ImportBatches(lines, format, batch_size)
+    counts = await db_service.import_questionnaires(batches)
+    return dict(counts, read=batches.read, invalid=batches.invalid, errors=batches.errors)
+
+
+def read_lines(binary) -> Iterator[str]:
+    """Decode a binary file line by line, dropping a UTF-8 byte order mark"""
+    return codecs.iterdecode(binary, 'utf-8-sig')
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Import questionnaires from a CSV or NDJSON file")
+    parser.add_argument('path', help="file to import, or - for standard input")
+    parser.add_argument('--format', choices=FORMATS, help="defaults to the file extension")
+    parser.add_argument('--batch-size', type=int, default=IMPORT_BATCH_SIZE)
+    args = parser.parse_args()
+
+    format = args.format or format_from_path(args.path)
+    if format is None:
+        parser.error("cannot tell the format from the file name, pass --format")
+    if args.path == '-':
+        result = await import_questionnaires(read_lines(sys.stdin.buffer), format, args.batch_size)
+    else:
+        with open(args.path, 'rb') as f:
+            result = await import_questionnaires(read_lines(f), format, args.batch_size)
+    for error in result['errors']:
+        print(f"line {error['line']}: {error['error']}")
+    print(f"Read {result['read']} rows: {result['inserted']} inserted, {result['updated']} updated, "
+          f"{result['unchanged']} unchanged, {result['invalid']} invalid")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
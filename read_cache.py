@@ -0,0 +1,99 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+# Seconds a cached read stays valid. Writes made through this process invalidate
+# their entries at once; the TTL bounds how stale other workers' views can get.
+READ_CACHE_TTL = float(os.getenv("READ_CACHE_TTL", "60"))
+READ_CACHE_SIZE = int(os.getenv("READ_CACHE_SIZE", "256"))
+
+_MISSING = object()
+
+
+class TTLCache:
+    """In-process LRU cache whose entries also expire after ttl seconds.
+
+    Keys are tuples such as ('groups',) or ('messages', group_name).
+    invalidate() drops a key and every key that starts with it, so
+    invalidate('messages') clears the messages of all groups.
+    """
+
+    def __init__(self, maxsize: int = READ_CACHE_SIZE, ttl: float = READ_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self.pending: Dict[tuple, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple, default: Any = _MISSING) -> Any:
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+        if entry is not None:
+            del self.entries[key]
+        self.misses += 1
+        return default
+
+    def set(self, key: tuple, value: Any):
+        if self.maxsize <= 0 or self.ttl <= 0:
+            return
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, *prefix: Hashable):
+        """Drop every entry whose key starts with prefix; no prefix clears the cache"""
+        for key in [key for key in self.entries if key[:len(prefix)] == prefix]:
+            del self.entries[key]
+        # A load that started before this write must not repopulate the old value
+        for key in [key for key in self.pending if key[:len(prefix)] == prefix]:
+            del self.pending[key]
+
+    def load(self, key: tuple, loader: Callable[[], Any]) -> Any:
+        value = self.get(key)
+        if value is _MISSING:
+            value = loader()
+            self.set(key, value)
+        return value
+
+    async def aload(self, key: tuple, loader: Callable[[], Awaitable[Any]]) -> Any:
+        """Like load() for coroutines; concurrent misses on one key share a single query.
+
+        The query runs in a task of its own, so cancelling the request that
+        started it leaves it running for the others waiting on it.
+        """
+        value = self.get(key)
+        if value is not _MISSING:
+            return value
+        task = self.pending.get(key)
+        if task is None:
+            task = asyncio.ensure_future(loader())
+            self.pending[key] = task
+            task.add_done_callback(lambda done: self._loaded(key, done))
+        return await asyncio.shield(task)
+
+    def _loaded(self, key: tuple, task: asyncio.Future):
+        # Retrieved here so a failure nobody waited for is not logged
+        failed = task.cancelled() or task.exception() is not None
+        # Only cache the result if no write invalidated the key while it loaded
+        if self.pending.get(key) is task:
+            del self.pending[key]
+            if not failed:
+                self.set(key, task.result())
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 3) if lookups else None,
+            "entries": len(self.entries),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+        }
@@ -1,25 +1,153 @@
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
+import asyncio
 import os.path
 import pickle
 import json
-from typing import List, Dict, Any
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+from functools import lru_cache
+from typing import List, Dict, Any, Optional
+from read_cache import TTLCache
+from sheets_writer import SheetsWriter
 
 SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
 SPREADSHEET_ID = os.getenv('SPREADSHEET_ID')
 QUESTIONNAIRE_RANGE = 'Questionnaire!A:F'
-MESSAGES_RANGE = 'Messages!A:E'
+MESSAGES_SHEET = 'Messages'
+MESSAGES_RANGE = f'{MESSAGES_SHEET}!A:E'
 GROUPS_RANGE = 'Groups!A:C'
+# Seconds between checks of the Messages sheet for rows appended by other processes
+SHEETS_MIRROR_REFRESH_INTERVAL = float(os.getenv('SHEETS_MIRROR_REFRESH_INTERVAL', '5'))
+# The OAuth token is refreshed in the background this many seconds before it expires
+SHEETS_TOKEN_REFRESH_MARGIN = float(os.getenv('SHEETS_TOKEN_REFRESH_MARGIN', '300'))
+TOKEN_RETRY_DELAY = 60
+
+
+# The Google client libraries are imported on first use, not at import time,
+# to keep cold starts of app.py fast.
+# The only API methods this service calls. Building a resource renders docstrings
+# for every method it has, so the discovery document is trimmed to these.
+SHEETS_VALUES_METHODS = ('get', 'append')
+
+
+@lru_cache(maxsize=None)
+def discovery_document() -> Dict[str, Any]:
+    """The Sheets v4 discovery document bundled with googleapiclient, parsed and trimmed once per process"""
+    from googleapiclient import discovery_cache
+    document = json.loads(discovery_cache.get_static_doc('sheets', 'v4'))
+    spreadsheets = document['resources']['spreadsheets']
+    values = spreadsheets['resources']['values']['methods']
+    spreadsheets['methods'] = {}
+    spreadsheets['resources'] = {
+        'values': {'methods': {name: values[name] for name in SHEETS_VALUES_METHODS}}
+    }
+    return document
+
+
+def build_sheets(creds):
+    """A spreadsheets() resource built from the cached discovery document, without any HTTP request"""
+    from googleapiclient.discovery import build_from_document
+    return build_from_document(discovery_document(), credentials=creds).spreadsheets()
+
+
+def questionnaire_row(data: Dict[str, Any]) -> List[Any]:
+    return [
+        data['email'],
+        data['hobbies'],
+        data['topics'],
+        data['gender'],
+        data['year'],
+        data['purpose']
+    ]
+
+
+def message_row(data: Dict[str, Any]) -> List[Any]:
+    return [
+        data['id'],
+        data['group_name'],
+        data['email'],
+        data['message'],
+        data['timestamp']
+    ]
+
+
+def messages_after(messages: List[Dict[str, Any]], message_id: str, limit: int) -> Optional[List[Dict[str, Any]]]:
+    for position in range(len(messages) - 1, -1, -1):
+        if messages[position].get('id') == message_id:
+            return messages[position + 1:][-limit:] if limit else []
+    return None
+
+
+class MessageMirror:
+    """Local copy of the Messages sheet, indexed by group.
+
+    rows_read is the number of sheet rows (header included) already
+    consumed, so a refresh only has to fetch the rows after it. Messages
+    are deduplicated by id, which lets this process add its own writes
+    straight away and skip them when they come back from the sheet.
+    """
 
-class SheetsService:
     def __init__(self):
-        self.creds = self._get_credentials()
-        self.service = build('sheets', 'v4', credentials=self.creds)
-        self.sheet = self.service.spreadsheets()
+        self.headers = None
+        self.rows_read = 0
+        self.by_group: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+        self.ids = set()
+        self.refreshed_at = None
+
+    def add(self, message: Dict[str, Any]):
+        message_id = message.get('id')
+        if message_id:
+            if message_id in self.ids:
+                return
+            self.ids.add(message_id)
+        self.by_group[message.get('group_name')].append(message)
+
+    def extend(self, values: List[List[str]]):
+        """Consume rows read from the sheet, starting at row rows_read + 1"""
+        self.rows_read += len(values)
+        if self.headers is None and values:
+            self.headers, values = values[0], values[1:]
+        for row in values:
+            self.add(dict(zip(self.headers, row)))
+
+    def get(self, group_name: str) -> List[Dict[str, Any]]:
+        return list(self.by_group.get(group_name, ()))
+
+
+class SheetsService:
+    def __init__(self, sheet=None):
+        """sheet replaces the Google API client, e.g. with fake_sheets.FakeSheets for offline use.
+
+        Credentials and the API client are only loaded on first use.
+        """
+        self.fake_sheet = sheet
+        self._sheet = sheet
+        self.creds = None
+        self._lock = threading.Lock()
+        self._refresh_timer = None
+        self.messages = MessageMirror()
+        # One mirror refresh at a time from the event loop
+        self._refresh_lock = asyncio.Lock()
+        # Queued writes; await writer.start() once the event loop is running
+        self.writer = SheetsWriter(self._writer_client, SPREADSHEET_ID, self._on_flushed)
+        # Every values().get counts against the Sheets quota (500 requests per 100s)
+        self.cache = TTLCache()
+
+    @property
+    def sheet(self):
+        if self._sheet is None:
+            with self._lock:
+                if self._sheet is None:
+                    self.creds = self._get_credentials()
+                    self._schedule_token_refresh()
+                    self._sheet = build_sheets(self.creds)
+        return self._sheet
 
     def _get_credentials(self):
+        from google_auth_oauthlib.flow import InstalledAppFlow
+        from google.auth.transport.requests import Request
+
         creds = None
         if os.path.exists('token.pickle'):
             with open('token.pickle', 'rb') as token:
@@ -37,10 +165,40 @@ class SheetsService:
 
         return creds
 
-    def get_questionnaire_data(self) -> List[Dict[str, Any]]:
+    def _schedule_token_refresh(self, delay: float = None):
+        if not getattr(self.creds, 'refresh_token', None) or self.creds.expiry is None:
+            return
+        if delay is None:
+            # google-auth keeps expiry as naive UTC
+            remaining = (self.creds.expiry - datetime.utcnow()).total_seconds()
+            delay = max(remaining - SHEETS_TOKEN_REFRESH_MARGIN, 0)
+        self._refresh_timer = threading.Timer(delay, self._refresh_token)
+        self._refresh_timer.daemon = True
+        self._refresh_timer.start()
+
+    def _refresh_token(self):
+        """Refresh the token before it expires, so no request has to wait for it"""
+        from google.auth.transport.requests import Request
+
+        try:
+            self.creds.refresh(Request())
+            with open('token.pickle', 'wb') as token:
+                pickle.dump(self.creds, token)
+        except Exception as e:
+            print(f"Error refreshing Sheets token, retrying in {TOKEN_RETRY_DELAY}s: {str(e)}")
+            self._schedule_token_refresh(TOKEN_RETRY_DELAY)
+            return
+        self._schedule_token_refresh()
+
+    def close(self):
+        if self._refresh_timer is not None:
+            self._refresh_timer.cancel()
+            self._refresh_timer = None
+
+    def _get_rows(self, range_name: str) -> List[Dict[str, Any]]:
         result = self.sheet.values().get(
             spreadsheetId=SPREADSHEET_ID,
-            range=QUESTIONNAIRE_RANGE
+            range=range_name
         ).execute()
         
         values = result.get('values', [])
@@ -50,15 +208,31 @@ class SheetsService:
         headers = values[0]
         return [dict(zip(headers, row)) for row in values[1:]]
 
+    def _writer_client(self):
+        """A separate API client for the writer thread, since clients must not be shared across threads"""
+        if self.fake_sheet is not None:
+            return self.fake_sheet
+        self.sheet  # loads the credentials
+        return build_sheets(self.creds)
+
+    def _on_flushed(self, ranges: List[str]):
+        if QUESTIONNAIRE_RANGE in ranges:
+            self.cache.invalidate('questionnaire')
+
+    async def queue_questionnaire(self, data: Dict[str, Any]):
+        """Queue a questionnaire row for the next batched append"""
+        await self.writer.put(QUESTIONNAIRE_RANGE, questionnaire_row(data))
+
+    async def queue_message(self, data: Dict[str, Any]):
+        """Queue a message for the next batched append; it is readable from the mirror at once"""
+        self.messages.add(dict(data))
+        await self.writer.put(MESSAGES_RANGE, message_row(data))
+
+    def get_questionnaire_data(self) -> List[Dict[str, Any]]:
+        return self.cache.load(('questionnaire',), lambda: self._get_rows(QUESTIONNAIRE_RANGE))
+
     def save_questionnaire(self, data: Dict[str, Any]):
-        values = [[
-            data['email'],
-            data['hobbies'],
-            data['topics'],
-            data['gender'],
-            data['year'],
-            data['purpose']
-        ]]
+        values = [questionnaire_row(data)]
         
         body = {
             'values': values
@@ -70,29 +244,57 @@ class SheetsService:
             valueInputOption='RAW',
             body=body
         ).execute()
+        self.cache.invalidate('questionnaire')
 
-    def get_messages(self, group_name: str) -> List[Dict[str, Any]]:
+    def _refresh_due(self, force: bool) -> bool:
+        refreshed_at = self.messages.refreshed_at
+        return force or refreshed_at is None or time.monotonic() - refreshed_at >= SHEETS_MIRROR_REFRESH_INTERVAL
+
+    def _fetch_messages(self, first_row: int) -> List[List[str]]:
         result = self.sheet.values().get(
             spreadsheetId=SPREADSHEET_ID,
-            range=MESSAGES_RANGE
+            range=f'{MESSAGES_SHEET}!A{first_row}:E'
         ).execute()
-        
-        values = result.get('values', [])
-        if not values:
-            return []
-            
-        headers = values[0]
-        messages = [dict(zip(headers, row)) for row in values[1:]]
-        return [msg for msg in messages if msg['group_name'] == group_name]
+        return result.get('values', [])
+
+    def refresh_messages(self, force: bool = False):
+        """Pull rows appended to the Messages sheet since the last refresh into the mirror"""
+        if not self._refresh_due(force):
+            return
+        self.messages.extend(self._fetch_messages(self.messages.rows_read + 1))
+        self.messages.refreshed_at = time.monotonic()
+
+    async def arefresh_messages(self, force: bool = False):
+        """Like refresh_messages, with the Sheets request made on a worker thread"""
+        async with self._refresh_lock:
+            if not self._refresh_due(force):
+                return
+            mirror = self.messages
+            rows_read = mirror.rows_read
+            values = await asyncio.get_running_loop().run_in_executor(None, self._fetch_messages, rows_read + 1)
+            # The mirror is only changed on the event loop; skip rows a synchronous refresh took meanwhile
+            if mirror.rows_read == rows_read:
+                mirror.extend(values)
+                mirror.refreshed_at = time.monotonic()
+
+    def get_messages(self, group_name: str) -> List[Dict[str, Any]]:
+        self.refresh_messages()
+        return self.messages.get(group_name)
+
+    async def aget_messages(self, group_name: str) -> List[Dict[str, Any]]:
+        await self.arefresh_messages()
+        return self.messages.get(group_name)
+
+    def get_messages_after(self, group_name: str, message_id: str, limit: int) -> Optional[List[Dict[str, Any]]]:
+        """The newest `limit` messages of a group after the one with id message_id, or None if it is unknown"""
+        return messages_after(self.get_messages(group_name), message_id, limit)
+
+    async def aget_messages_after(self, group_name: str, message_id: str,
+                                  limit: int) -> Optional[List[Dict[str, Any]]]:
+        return messages_after(await self.aget_messages(group_name), message_id, limit)
 
     def save_message(self, data: Dict[str, Any]):
-        values = [[
-            data['id'],
-            data['group_name'],
-            data['email'],
-            data['message'],
-            data['timestamp']
-        ]]
+        values = [message_row(data)]
         
         body = {
             'values': values
@@ -104,19 +306,10 @@ class SheetsService:
             valueInputOption='RAW',
             body=body
         ).execute()
+        self.messages.add(dict(data))
 
     def get_groups(self) -> List[Dict[str, Any]]:
-        result = self.sheet.values().get(
-            spreadsheetId=SPREADSHEET_ID,
-            range=GROUPS_RANGE
-        ).execute()
-        
-        values = result.get('values', [])
-        if not values:
-            return []
-            
-        headers = values[0]
-        return [dict(zip(headers, row)) for row in values[1:]]
+        return self.cache.load(('groups',), lambda: self._get_rows(GROUPS_RANGE))
 
     def save_groups(self, groups: List[Dict[str, Any]]):
         values = [[
@@ -134,4 +327,5 @@ class SheetsService:
             range=GROUPS_RANGE,
             valueInputOption='RAW',
             body=body
-        ).execute() 
\ No newline at end of file
+        ).execute()
+        self.cache.invalidate('groups')
\ No newline at end of file
@@ -0,0 +1,221 @@
+import asyncio
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+from message_writer import MessageWriter
+
+SHEETS_FLUSH_INTERVAL_MS = int(os.getenv("SHEETS_FLUSH_INTERVAL_MS", "1000"))
+SHEETS_BATCH_SIZE = int(os.getenv("SHEETS_BATCH_SIZE", "500"))
+SHEETS_QUEUE_SIZE = int(os.getenv("SHEETS_QUEUE_SIZE", "10000"))
+SHEETS_MAX_RETRY_DELAY = float(os.getenv("SHEETS_MAX_RETRY_DELAY", "64"))
+# Journal of queued rows. Rows are on disk before a handler returns and are
+# replayed on the next start if the process dies before they are written.
+# An empty value turns it off, and queued rows are then lost on a crash.
+SHEETS_SPOOL_PATH = os.getenv("SHEETS_SPOOL_PATH", "sheets_spool.ndjson")
+SHEETS_SPOOL_FSYNC = os.getenv("SHEETS_SPOOL_FSYNC", "true").lower() in ("1", "true", "yes")
+# Quota (429) and server errors are retried; other API errors drop the rows
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+
+def is_retryable(error: Exception) -> bool:
+    status = getattr(getattr(error, 'resp', None), 'status', None)
+    # No HTTP status means a network error, which is worth retrying
+    return status is None or int(status) in RETRYABLE_STATUSES
+
+
+class SpoolJournal:
+    """Append-only file of queued rows plus acknowledgements of flushed ones.
+
+    Each row gets an increasing seq. Batches are flushed in order, so one
+    {"ack": seq} line covers every earlier row. The file is truncated
+    whenever everything written to it has been acknowledged.
+
+    Writes and fsyncs run on a thread of their own. Lines that arrive while
+    one write is in flight go out together in the next, with a single fsync.
+    """
+
+    def __init__(self, path: str, fsync: bool = SHEETS_SPOOL_FSYNC):
+        self.path = path
+        self.fsync = fsync
+        self.seq = 0
+        self.acked = 0
+        self.file = None
+        # One thread keeps the file operations in order
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sheets-journal')
+        self.lines: List[str] = []
+        # Resolved once the lines buffered so far are on disk
+        self.written: Optional[asyncio.Future] = None
+        self.writing = None
+
+    def open(self) -> List[Dict[str, Any]]:
+        """Open the journal and return the rows that were queued but never acknowledged"""
+        pending: Dict[int, Dict[str, Any]] = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Torn last line from a crash mid-write
+                        continue
+                    if 'ack' in record:
+                        pending = {seq: entry for seq, entry in pending.items() if seq > record['ack']}
+                    else:
+                        pending[record['seq']] = record
+                        self.seq = max(self.seq, record['seq'])
+        entries = [pending[seq] for seq in sorted(pending)]
+        self.acked = entries[0]['seq'] - 1 if entries else self.seq
+        # Compact to just the unacknowledged rows
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + '\n')
+        os.replace(tmp_path, self.path)
+        self.file = open(self.path, 'a')
+        return entries
+
+    async def append(self, entry: Dict[str, Any]) -> int:
+        self.seq += 1
+        entry['seq'] = seq = self.seq
+        await self._write(entry)
+        return seq
+
+    async def ack(self, seq: int):
+        self.acked = max(self.acked, seq)
+        if self.acked >= self.seq:
+            # Every row ever appended was acknowledged, so no write is buffered or in flight
+            await asyncio.get_running_loop().run_in_executor(self.executor, self._truncate)
+        else:
+            await self._write({'ack': self.acked})
+
+    async def _write(self, record: Dict[str, Any]):
+        self.lines.append(json.dumps(record) + '\n')
+        if self.written is None:
+            self.written = asyncio.get_running_loop().create_future()
+        written = self.written
+        if self.writing is None:
+            self.writing = asyncio.ensure_future(self._write_buffered())
+        await asyncio.shield(written)
+
+    async def _write_buffered(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while self.lines:
+                lines, self.lines = self.lines, []
+                written, self.written = self.written, None
+                try:
+                    await loop.run_in_executor(self.executor, self._write_lines, lines)
+                except Exception as e:
+                    written.set_exception(e)
+                    # Retrieved here so a failure nobody waited for is not logged
+                    written.exception()
+                else:
+                    written.set_result(None)
+        finally:
+            self.writing = None
+
+    def _write_lines(self, lines: List[str]):
+        self.file.write(''.join(lines))
+        self.file.flush()
+        if self.fsync:
+            os.fsync(self.file.fileno())
+
+    def _truncate(self):
+        self.file.seek(0)
+        self.file.truncate()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class SheetsWriter:
+    """Queues Sheets appends and writes them from a worker thread.
+
+    Rows queued within one flush interval are coalesced into a single
+    values().append per range, so the event loop never waits on Google and
+    a burst of messages costs one write request. Quota and server errors
+    are retried with exponential backoff up to SHEETS_MAX_RETRY_DELAY.
+    """
+
+    def __init__(self, make_client: Callable[[], Any], spreadsheet_id: str,
+                 on_flushed: Optional[Callable[[List[str]], None]] = None,
+                 spool_path: Optional[str] = SHEETS_SPOOL_PATH,
+                 batch_size: int = SHEETS_BATCH_SIZE,
+                 flush_interval_ms: int = SHEETS_FLUSH_INTERVAL_MS,
+                 max_pending: int = SHEETS_QUEUE_SIZE):
+        self.make_client = make_client
+        self.spreadsheet_id = spreadsheet_id
+        self.on_flushed = on_flushed
+        self.client = None
+        # One thread: the Google API client is not thread-safe, and batches go out in order anyway
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sheets-writer')
+        self.journal = SpoolJournal(spool_path) if spool_path else None
+        self.writer = MessageWriter(self._append_batch, batch_size, flush_interval_ms, max_pending,
+                                    max_retry_delay=SHEETS_MAX_RETRY_DELAY)
+        self.rows_written = 0
+        self.rows_dropped = 0
+
+    async def start(self):
+        replayed = []
+        if self.journal is None:
+            print("WARNING: SHEETS_SPOOL_PATH is empty, so queued Sheets rows are lost if the process stops "
+                  "before they are written")
+        elif self.journal.file is None:
+            replayed = await asyncio.get_running_loop().run_in_executor(self.journal.executor, self.journal.open)
+            if replayed:
+                print(f"Replaying {len(replayed)} Sheets rows from {self.journal.path}")
+        self.writer.start()
+        # Ahead of any new row, so acknowledgements still cover earlier seqs only;
+        # waits for the writer when there are more rows than the queue holds
+        for entry in replayed:
+            await self.writer.put(entry)
+
+    async def put(self, range_name: str, row: List[Any]):
+        entry = {'range': range_name, 'values': row}
+        if self.journal is not None:
+            await self.journal.append(entry)
+        await self.writer.put(entry)
+
+    async def stop(self, timeout: float = 30.0):
+        await self.writer.stop(timeout)
+        if self.journal is not None:
+            self.journal.close()
+
+    async def _append_batch(self, entries: List[Dict[str, Any]]):
+        loop = asyncio.get_running_loop()
+        by_range: Dict[str, List[Dict[str, Any]]] = {}
+        for entry in entries:
+            # A retried batch skips the ranges an earlier attempt already wrote
+            if not entry.get('written'):
+                by_range.setdefault(entry['range'], []).append(entry)
+
+        for range_name, range_entries in by_range.items():
+            rows = [entry['values'] for entry in range_entries]
+            try:
+                await loop.run_in_executor(self.executor, self._append, range_name, rows)
+                self.rows_written += len(rows)
+            except Exception as e:
+                if is_retryable(e):
+                    raise
+                print(f"Dropping {len(rows)} rows for {range_name}: {str(e)}")
+                self.rows_dropped += len(rows)
+            for entry in range_entries:
+                entry['written'] = True
+
+        if self.journal is not None:
+            await self.journal.ack(max(entry.get('seq', 0) for entry in entries))
+        if self.on_flushed is not None:
+            self.on_flushed(list(by_range))
+
+    def _append(self, range_name: str, rows: List[List[Any]]):
+        if self.client is None:
+            self.client = self.make_client()
+        self.client.values().append(
+            spreadsheetId=self.spreadsheet_id,
+            range=range_name,
+            valueInputOption='RAW',
+            body={'values': rows}
+        ).execute()
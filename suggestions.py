@@ -0,0 +1,230 @@
+import os
+import numpy as np
+from scipy import sparse
+from typing import Any, Dict, List, Optional
+from features import FeatureEncoder
+from pickle_store import SharedPickle
+
+SUGGESTIONS_INDEX_PATH = os.getenv("SUGGESTIONS_INDEX_PATH", "suggestions_index.pickle")
+# Neighbours precomputed per user, and so the most /suggestions can return
+SUGGESTIONS_K = int(os.getenv("SUGGESTIONS_K", "10"))
+# Users per block while building the index; peak memory is about this many
+# users times the number of candidates float32s.
+SUGGESTIONS_CHUNK_SIZE = int(os.getenv("SUGGESTIONS_CHUNK_SIZE", "256"))
+# Up to this many users every pair is compared. Larger cohorts are split into
+# k-means partitions of about SUGGESTIONS_PARTITION_SIZE users, and each user
+# is compared with the users of the SUGGESTIONS_PROBES partitions nearest its own.
+# Approximate: on synthetic data about a third of users miss some of their exact
+# k neighbours, though the scores found are about 98% of the exact ones.
+SUGGESTIONS_EXACT_MAX_USERS = int(os.getenv("SUGGESTIONS_EXACT_MAX_USERS", "10000"))
+SUGGESTIONS_PARTITION_SIZE = int(os.getenv("SUGGESTIONS_PARTITION_SIZE", "1000"))
+SUGGESTIONS_PROBES = int(os.getenv("SUGGESTIONS_PROBES", "3"))
+
+
+def jaccard(intersections, sizes, size) -> np.ndarray:
+    """Shared answers over answers given by either user, 0 when neither answered anything.
+
+    Overwrites intersections, which is a scratch block in every caller.
+    """
+    unions = sizes + size
+    unions -= intersections
+    # An empty union means no shared answers either, so 0 / 1
+    np.maximum(unions, 1, out=unions)
+    intersections /= unions
+    return intersections
+
+
+def top_k(scores: np.ndarray, k: int):
+    """Column indices and scores of the k best entries of each row, best first (ties by index)"""
+    k = min(k, scores.shape[1])
+    # The k-th best of the first columns is a lower bound on the row's k-th
+    # best, so only entries at or above it are sorted; cheaper than argpartition.
+    sample = min(scores.shape[1], max(16 * k, 1024))
+    bounds = np.partition(scores[:, :sample], sample - k, axis=1)[:, sample - k]
+    rows, columns = np.nonzero(scores >= bounds[:, None])
+    values = scores[rows, columns]
+    order = np.lexsort((columns, -values, rows))
+    columns, values = columns[order], values[order]
+    # Every row has at least k candidates, the sample's best
+    take = np.searchsorted(rows[order], np.arange(scores.shape[0]))[:, None] + np.arange(k)
+    return columns[take], values[take]
+
+
+def partition_candidates(features: np.ndarray, partition_size: int, probes: int):
+    """(users, candidates) row arrays: each k-means partition and the users of the partitions nearest it"""
+    # Deferred so the web app does not load scikit-learn just to serve lookups
+    from sklearn.cluster import MiniBatchKMeans
+    from sklearn.metrics.pairwise import euclidean_distances
+    from cluster_backends import CLUSTERING_BATCH_SIZE, CLUSTERING_SEED
+
+    n_partitions = max(1, len(features) // partition_size)
+    model = MiniBatchKMeans(n_clusters=n_partitions, batch_size=CLUSTERING_BATCH_SIZE, n_init=1,
+                            random_state=CLUSTERING_SEED)
+    labels = model.fit_predict(features)
+    distances = euclidean_distances(model.cluster_centers_)
+    # A partition always searches itself, even when another centre coincides with its own
+    np.fill_diagonal(distances, -1)
+    nearest = np.argsort(distances, axis=1, kind='stable')[:, :probes]
+    order = np.argsort(labels, kind='stable')
+    members = np.split(order, np.cumsum(np.bincount(labels, minlength=n_partitions))[:-1])
+    for partition, users in enumerate(members):
+        if len(users):
+            yield users, np.sort(np.concatenate([members[other] for other in nearest[partition]]))
+
+
+class SuggestionIndex:
+    """The k most similar users of every user, by Jaccard similarity of their answers.
+
+    Built by the clustering job, so /suggestions is a lookup. New and
+    edited submissions are added in place: their neighbours are found by
+    one pass over the stored features, and they enter the lists of the
+    users they are now closer to. An edited user's old row is kept but
+    marked inactive until the next rebuild. The per-user arrays keep spare
+    rows, doubling when full, so adding a user rarely copies them.
+    """
+
+    def __init__(self, encoder: FeatureEncoder, features, emails: List[str], neighbours, scores, k: int):
+        self.encoder = encoder
+        # Answers are binary, so dot products count shared answers. Few
+        # columns and many users make dense matrix products the fast way.
+        self.features = _dense(features)
+        self.sizes = self.features.sum(axis=1)
+        self.emails = list(emails)
+        self.rows = {email: row for row, email in enumerate(self.emails)}
+        self.active = np.ones(len(self.emails), dtype=bool)
+        self.neighbours = neighbours
+        self.scores = scores
+        self.k = k
+
+    @classmethod
+    def build(cls, encoder: FeatureEncoder, features, emails: List[str], k: int = SUGGESTIONS_K,
+              chunk_size: int = SUGGESTIONS_CHUNK_SIZE, exact_max_users: int = SUGGESTIONS_EXACT_MAX_USERS,
+              partition_size: int = SUGGESTIONS_PARTITION_SIZE,
+              probes: int = SUGGESTIONS_PROBES) -> 'SuggestionIndex':
+        dense = _dense(features)
+        n = len(dense)
+        sizes = dense.sum(axis=1)
+        neighbours = np.full((n, k), -1, dtype=np.int32)
+        scores = np.full((n, k), -1, dtype=np.float32)
+        if n <= exact_max_users:
+            searches = [(np.arange(n), np.arange(n))]
+        else:
+            searches = partition_candidates(dense, partition_size, probes)
+        for users, candidates in searches:
+            others = dense[candidates].T
+            for start in range(0, len(users), chunk_size):
+                rows = users[start:start + chunk_size]
+                block = jaccard(dense[rows] @ others, sizes[None, candidates], sizes[rows, None])
+                # Never suggest users to themselves; every user is among its own candidates
+                block[np.arange(len(rows)), np.searchsorted(candidates, rows)] = -1
+                found, found_scores = top_k(block, k)
+                neighbours[rows, :found.shape[1]] = candidates[found]
+                scores[rows, :found.shape[1]] = found_scores
+        # Fewer than k other candidates leaves the self match in the last column
+        neighbours[scores < 0] = -1
+        return cls(encoder, dense, emails, neighbours, scores, k)
+
+    def suggest(self, email: str, k: int = SUGGESTIONS_K) -> Optional[List[Dict[str, Any]]]:
+        """Precomputed matches for a user in the index, best first; None if the user is not in it"""
+        row = self.rows.get(email)
+        if row is None:
+            return None
+        return self._matches(self.neighbours[row], self.scores[row], k)
+
+    def query(self, data: Dict[str, Any], k: int = SUGGESTIONS_K) -> List[Dict[str, Any]]:
+        """Matches for a questionnaire row, computed against every user in the index"""
+        vector = self._vector(data)
+        found, found_scores = top_k(self._similarities(vector, exclude=data.get('email'))[None, :], k)
+        return self._matches(found[0], found_scores[0], k)
+
+    def add(self, data: Dict[str, Any]):
+        """Add a new or edited submission and update the neighbour lists it belongs in"""
+        email = data['email']
+        vector = self._vector(data)
+        similarities = self._similarities(vector, exclude=email)
+        found, found_scores = top_k(similarities[None, :], self.k)
+        neighbours = np.full(self.k, -1, dtype=np.int32)
+        scores = np.full(self.k, -1, dtype=np.float32)
+        neighbours[:found.shape[1]] = found[0]
+        scores[:found.shape[1]] = found_scores[0]
+
+        if email in self.rows:
+            self.active[self.rows[email]] = False
+        row = len(self.emails)
+        # Users whose k-th best match is worse than the newcomer
+        closer = np.flatnonzero(self.active[:row] & (similarities > self.scores[:row, -1]))
+        for other in closer:
+            merged = np.append(self.neighbours[other], row)
+            merged_scores = np.append(self.scores[other], similarities[other])
+            order = np.lexsort((merged, -merged_scores))[:self.k]
+            self.neighbours[other] = merged[order]
+            self.scores[other] = merged_scores[order]
+
+        self._reserve(row + 1)
+        self.emails.append(email)
+        self.rows[email] = row
+        self.features[row] = vector
+        self.sizes[row] = vector.sum()
+        self.active[row] = True
+        self.neighbours[row] = neighbours
+        self.scores[row] = scores
+
+    def _reserve(self, rows: int):
+        """Grow the per-user arrays to hold at least rows users, doubling so adds seldom copy"""
+        capacity = len(self.active)
+        if rows <= capacity:
+            return
+        capacity = max(rows, 2 * capacity)
+        for name, fill in (('features', 0), ('sizes', 0), ('active', False), ('neighbours', -1), ('scores', -1)):
+            array = getattr(self, name)
+            grown = np.full((capacity,) + array.shape[1:], fill, dtype=array.dtype)
+            grown[:len(array)] = array
+            setattr(self, name, grown)
+
+    def _vector(self, data: Dict[str, Any]) -> np.ndarray:
+        return self.encoder.transform([data]).toarray()[0].astype(np.float32)
+
+    def _similarities(self, vector: np.ndarray, exclude: Optional[str] = None) -> np.ndarray:
+        """Similarity of vector to every stored user; -1 for inactive rows and for exclude"""
+        n = len(self.emails)
+        similarities = jaccard(self.features[:n] @ vector, self.sizes[:n], np.float32(vector.sum()))
+        similarities[~self.active[:n]] = -1
+        if exclude in self.rows:
+            similarities[self.rows[exclude]] = -1
+        return similarities
+
+    def _matches(self, neighbours, scores, k: int) -> List[Dict[str, Any]]:
+        matches = []
+        for row, score in zip(neighbours, scores):
+            # Unused slots, and rows replaced by a later edit
+            if row < 0 or score < 0 or not self.active[row]:
+                continue
+            matches.append({'email': self.emails[row], 'score': round(float(score), 4)})
+            if len(matches) == k:
+                break
+        return matches
+
+
+def _dense(features) -> np.ndarray:
+    if sparse.issparse(features):
+        features = features.toarray()
+    return np.asarray(features, dtype=np.float32)
+
+
+_suggestion_index = SharedPickle(SUGGESTIONS_INDEX_PATH)
+
+
+def set_suggestion_index(index: SuggestionIndex):
+    _suggestion_index.set(index)
+
+
+def get_suggestion_index() -> Optional[SuggestionIndex]:
+    """The current index, reloaded when another process (e.g. the clustering job) wrote a newer one"""
+    return _suggestion_index.get()
+
+
+def add_submission(data: Dict[str, Any]):
+    """Make a freshly submitted questionnaire searchable right away"""
+    index = get_suggestion_index()
+    if index is not None:
+        index.add(data)
@@ -0,0 +1,19 @@
+import os
+import sys
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The app is a set of top-level modules, and bench/ has the synthetic data generator
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'bench')]
+
+
+@pytest.fixture
+def encode():
+    """encode(n_users, seed=1): encoded features of synthetic questionnaires"""
+    from datasets import synthetic_questionnaires
+    from features import FeatureEncoder
+
+    def encode(n_users, seed=1):
+        df = synthetic_questionnaires(n_users, seed)
+        return FeatureEncoder().fit_transform(df.to_dict('records'))
+    return encode
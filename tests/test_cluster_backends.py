@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+from cluster_backends import balance_labels, cluster_sharded
+
+
+@pytest.mark.parametrize('n_users', [8, 9, 11, 13, 17, 50, 97, 240])
+@pytest.mark.parametrize('n_labels', [1, 3, 40])
+def test_balance_labels_keeps_every_group_within_bounds(n_users, n_labels, encode):
+    features = encode(n_users)
+    rng = np.random.default_rng(n_users * 100 + n_labels)
+    labels = rng.integers(0, min(n_labels, n_users), size=n_users)
+
+    balanced = balance_labels(features, labels, min_size=4, max_size=6)
+
+    sizes = np.bincount(balanced)
+    assert len(balanced) == n_users
+    assert sizes.min() >= 4 and sizes.max() <= 6
+
+
+def test_balance_labels_is_deterministic_for_a_seed(encode):
+    features = encode(300)
+    labels = np.random.default_rng(0).integers(0, 30, size=300)
+
+    first = balance_labels(features, labels, random_state=7)
+    second = balance_labels(features, labels, random_state=7)
+
+    assert np.array_equal(first, second)
+
+
+def test_balance_labels_leaves_balanced_groups_alone(encode):
+    features = encode(60)
+    labels = np.repeat(np.arange(12), 5)
+
+    balanced = balance_labels(features, labels)
+
+    # Same partition; only the label numbers may differ
+    assert len(set(zip(labels, balanced))) == 12
+
+
+def test_cluster_sharded_does_not_depend_on_workers(encode):
+    features = encode(400)
+    shard_keys = np.array(['First year', 'Second year', 'Third year', 'Fourth year'])[np.arange(400) % 4]
+
+    serial = cluster_sharded(features, shard_keys, workers=1)
+    parallel = cluster_sharded(features, shard_keys, workers=4)
+
+    assert np.array_equal(serial, parallel)
+    sizes = np.bincount(serial)
+    assert sizes.min() >= 4 and sizes.max() <= 6
+
+
+def test_cluster_sharded_keeps_groups_within_a_shard(encode):
+    features = encode(200)
+    shard_keys = np.where(np.arange(200) < 120, 'a', 'b')
+
+    labels = cluster_sharded(features, shard_keys, workers=1)
+
+    for label in np.unique(labels):
+        assert len(set(shard_keys[labels == label])) == 1
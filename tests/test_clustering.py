@@ -0,0 +1,17 @@
+import numpy as np
+import pytest
+from scipy import sparse
+from sklearn.metrics.pairwise import euclidean_distances
+from clustering import mean_euclidean_distances
+
+
+@pytest.mark.parametrize('chunk_size', [7, 1024])
+def test_mean_euclidean_distances_matches_the_full_matrix(chunk_size, encode):
+    features = encode(500)
+    # Duplicate rows take the shortcut for identical answer sets
+    features = sparse.vstack([features, features[:50]], format='csr')
+
+    means = mean_euclidean_distances(features, chunk_size=chunk_size)
+
+    expected = euclidean_distances(features).mean(axis=1)
+    assert np.allclose(means, expected, atol=1e-9)
@@ -0,0 +1,85 @@
+import asyncio
+import numpy as np
+import pandas as pd
+
+import clustering
+from clustering_cache import ClusteringCache
+from datasets import synthetic_questionnaires
+from features import FEATURE_FIELDS, FeatureEncoder
+
+
+def make_cache(n_users=50):
+    rows = synthetic_questionnaires(n_users, 1).to_dict('records')
+    encoder = FeatureEncoder()
+    features = encoder.fit_transform(rows)
+    df = pd.DataFrame([{key: value for key, value in row.items() if key not in FEATURE_FIELDS} for row in rows])
+    hashes = [f'hash{i}' for i in range(n_users)]
+    cache = ClusteringCache(df, hashes, encoder, features, np.zeros(n_users, dtype=np.int64), 10, 1)
+    return cache, rows
+
+
+def test_patch_encodes_only_changed_rows(monkeypatch):
+    cache, rows = make_cache()
+    edited = dict(rows[7], email=rows[3]['email'], purpose=rows[3]['purpose'], row_hash='edited')
+    added = dict(rows[9], email='new@example.edu', row_hash='added')
+    # rows[5] was deleted
+    hashes = [(row['email'], f'hash{i}') for i, row in enumerate(rows) if i != 5]
+    hashes[3] = (edited['email'], 'edited')
+    hashes.append((added['email'], 'added'))
+
+    assert cache.changed_emails(hashes) == [edited['email'], added['email']]
+
+    encoded = []
+    transform_tokens = cache.encoder.transform_tokens
+    monkeypatch.setattr(cache.encoder, 'transform_tokens',
+                        lambda tokenized: encoded.append(len(tokenized)) or transform_tokens(tokenized))
+    df, row_hashes, encoder, features = cache.patch(hashes, [edited, added])
+
+    assert encoded == [2]
+    expected = [row for i, row in enumerate(rows) if i != 5]
+    expected[3] = edited
+    expected.append(added)
+    assert df['email'].tolist() == [row['email'] for row in expected]
+    assert df.columns.tolist() == ['email', 'purpose']
+    assert row_hashes == [row_hash for _, row_hash in hashes]
+    assert (features != encoder.transform(expected)).nnz == 0
+
+
+def test_patch_refuses_answers_outside_the_vocabulary():
+    cache, rows = make_cache()
+    added = dict(rows[0], email='new@example.edu', hobbies='underwater hockey', row_hash='added')
+    hashes = [(row['email'], f'hash{i}') for i, row in enumerate(rows)] + [(added['email'], 'added')]
+
+    assert cache.patch(hashes, [added]) is None
+
+
+def test_unchanged_fingerprint_skips_the_run(monkeypatch, tmp_path):
+    cache, _ = make_cache()
+    index_path = tmp_path / 'suggestions_index.pickle'
+    index_path.write_bytes(b'')
+
+    async def fingerprint():
+        return {'rows': cache.rows, 'digest': cache.digest, 'generation': cache.generation}
+
+    async def not_expected(*args, **kwargs):
+        raise AssertionError('an unchanged run must not load or save anything')
+
+    monkeypatch.setattr(clustering.ClusteringCache, 'load', classmethod(lambda cls: cache))
+    monkeypatch.setattr(clustering.db_service, 'questionnaire_fingerprint', fingerprint)
+    monkeypatch.setattr(clustering.db_service, 'save_groups', not_expected)
+    monkeypatch.setattr(clustering.db_service, 'stream_questionnaire_hashes', not_expected)
+    monkeypatch.setattr(clustering, 'SUGGESTIONS_INDEX_PATH', str(index_path))
+    monkeypatch.setattr(clustering, 'set_suggestion_index', not_expected)
+
+    result = asyncio.run(clustering.run_clustering())
+
+    assert result == {'users': 50, 'groups': 10, 'generation': 1, 'unchanged': True}
+
+
+
+def test_new_group_generation_misses_the_cache():
+    cache, _ = make_cache()
+
+    assert cache.matches({'rows': 50, 'digest': cache.digest, 'generation': 1})
+    assert not cache.matches({'rows': 50, 'digest': cache.digest, 'generation': 2})
+    assert not cache.matches({'rows': 50, 'digest': 'other', 'generation': 1})
@@ -0,0 +1,85 @@
+import asyncio
+import json
+
+from connection_manager import SLOW_CLIENT_CLOSE_CODE, ConnectionManager, ReplayBuffer
+
+
+def test_replay_buffer_returns_messages_after_last_id():
+    buffer = ReplayBuffer(size=3)
+    for i in range(5):
+        buffer.append('g', f'id{i}', f'payload{i}')
+
+    snapshot = buffer.snapshot('g')
+
+    assert [message_id for message_id, _ in snapshot] == ['id2', 'id3', 'id4']
+    assert ReplayBuffer.after(snapshot, 'id2') == ['payload3', 'payload4']
+    assert ReplayBuffer.after(snapshot, 'id4') == []
+    # Evicted or unknown ids cannot be resumed from the buffer
+    assert ReplayBuffer.after(snapshot, 'id0') is None
+
+
+def test_replay_buffer_evicts_least_recent_groups_over_the_byte_cap():
+    payload = 'x' * 1000
+    buffer = ReplayBuffer(size=10, max_bytes=3500)
+    buffer.append('old', 'a', payload)
+    buffer.append('old', 'b', payload)
+    buffer.append('new', 'c', payload)
+    buffer.append('new', 'd', payload)
+
+    assert buffer.bytes <= 3500
+    assert [message_id for message_id, _ in buffer.snapshot('old')] == ['b']
+    assert [message_id for message_id, _ in buffer.snapshot('new')] == ['c', 'd']
+
+
+def test_replay_buffer_disabled_with_size_zero():
+    buffer = ReplayBuffer(size=0)
+    buffer.append('g', 'a', 'payload')
+    assert buffer.snapshot('g') == []
+
+
+class FakeWebSocket:
+    """Records what is sent; a stalled socket never finishes a send"""
+
+    def __init__(self, stalled=False):
+        self.stalled = stalled
+        self.sent = []
+        self.close_code = None
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, payload):
+        if self.stalled:
+            await asyncio.Event().wait()
+        self.sent.append(payload)
+
+    async def close(self, code=1000):
+        self.close_code = code
+
+
+async def settle():
+    """Let every sender task run until it blocks again"""
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+
+def test_slow_client_is_dropped_without_delaying_the_group():
+    async def run():
+        manager = ConnectionManager(max_queue=2, send_timeout=60)
+        fast, slow = FakeWebSocket(), FakeWebSocket(stalled=True)
+        await manager.connect(fast, 'g')
+        await manager.connect(slow, 'g')
+        await settle()
+
+        # The stalled sender holds one message, two more fill its queue
+        for i in range(5):
+            await manager.broadcast({'id': f'id{i}', 'text': str(i)}, 'g')
+            await settle()
+
+        assert slow.close_code == SLOW_CLIENT_CLOSE_CODE
+        assert list(manager.active_connections['g']) == [fast]
+        assert [json.loads(payload)['id'] for payload in fast.sent] == [f'id{i}' for i in range(5)]
+        assert not manager.tasks
+        manager.disconnect(fast, 'g')
+
+    asyncio.run(run())
@@ -0,0 +1,58 @@
+import numpy as np
+
+from datasets import synthetic_questionnaires
+from features import FeatureEncoder
+
+
+def questionnaires(n_users=500):
+    rows = synthetic_questionnaires(n_users, 1).to_dict('records')
+    # Missing and blank answers encode as no columns
+    rows[0]['hobbies'] = None
+    rows[1]['gender'] = float('nan')
+    rows[2]['topics'] = ' , '
+    return rows
+
+
+def assert_same_csr(left, right):
+    assert left.shape == right.shape
+    np.testing.assert_array_equal(left.indptr, right.indptr)
+    np.testing.assert_array_equal(left.indices, right.indices)
+    np.testing.assert_array_equal(left.data, right.data)
+
+
+def test_partial_fit_in_chunks_matches_one_shot_fit():
+    rows = questionnaires()
+    one_shot = FeatureEncoder()
+    expected = one_shot.fit_transform(rows)
+
+    chunked = FeatureEncoder()
+    for start in range(0, len(rows), 64):
+        chunked.partial_fit(rows[start:start + 64])
+    features = chunked.finalize()
+
+    assert chunked.vocabulary_ == one_shot.vocabulary_
+    assert_same_csr(features, expected)
+    assert_same_csr(chunked.transform(rows), expected)
+    assert features[0, chunked.field_slice('hobbies')].nnz == 0
+
+
+def test_columns_do_not_depend_on_row_order():
+    rows = questionnaires()
+    forward = FeatureEncoder().fit_transform(rows)
+    backward = FeatureEncoder().fit_transform(rows[::-1])
+
+    assert_same_csr(backward[::-1].tocsr(), forward)
+
+
+def test_covers_tokens_rejects_unseen_answers():
+    rows = questionnaires()
+    encoder = FeatureEncoder()
+    encoder.fit_transform(rows)
+    unseen_hobby = dict(rows[3], hobbies=rows[3]['hobbies'] + ',underwater hockey')
+    unseen_year = dict(rows[3], year='Sixth year')
+
+    assert encoder.covers_tokens(FeatureEncoder.tokenize(rows[:10]))
+    assert not encoder.covers_tokens(FeatureEncoder.tokenize([unseen_hobby]))
+    assert not encoder.covers_tokens(FeatureEncoder.tokenize([rows[4], unseen_year]))
+    # transform drops what covers_tokens reports
+    assert_same_csr(encoder.transform([unseen_hobby]), encoder.transform([rows[3]]))
@@ -0,0 +1,108 @@
+import asyncio
+import pytest
+
+import incremental
+from features import FeatureEncoder
+from incremental import GroupModel
+
+PROFILES = [
+    {'hobbies': 'Coding,Gaming', 'topics': 'Technology', 'gender': 'Male', 'year': 'First year'},
+    {'hobbies': 'Music,Reading', 'topics': 'Art,History', 'gender': 'Female', 'year': 'Final year'},
+    {'hobbies': 'Hiking,Sports', 'topics': 'Travel', 'gender': 'Other', 'year': 'Second year'},
+]
+
+
+def make_model(group_size=4):
+    """One group of identical answers per profile"""
+    rows, groups = [], []
+    for index, profile in enumerate(PROFILES):
+        emails = [f'g{index}u{i}@example.com' for i in range(group_size)]
+        rows += [dict(profile, email=email) for email in emails]
+        groups.append({'id': index + 1, 'group_name': f'group{index}', 'email': ','.join(emails)})
+    encoder = FeatureEncoder()
+    features = encoder.fit_transform(rows)
+    return GroupModel.fit(encoder, features, [row['email'] for row in rows], groups)
+
+
+@pytest.fixture
+def placement(monkeypatch):
+    """Serves a model to assign_submission and records add_group_member calls; refused holds group ids to reject"""
+    state = {'model': make_model(), 'calls': [], 'refused': set()}
+
+    async def add_group_member(group_id, email, max_size):
+        state['calls'].append(group_id)
+        return group_id not in state['refused']
+
+    async def get_group_for_member(email):
+        return None
+
+    monkeypatch.setattr(incremental, 'get_group_model', lambda: state['model'])
+    monkeypatch.setattr(incremental.db_service, 'add_group_member', add_group_member)
+    monkeypatch.setattr(incremental.db_service, 'get_group_for_member', get_group_for_member)
+    return state
+
+
+def test_submission_joins_the_nearest_group(placement):
+    model = placement['model']
+
+    group = asyncio.run(incremental.assign_submission(dict(PROFILES[1], email='new@example.com')))
+
+    assert group['group_name'] == 'group1'
+    assert placement['calls'] == [2]
+    assert model.sizes.tolist() == [4, 5, 4]
+    assert model.added == 1
+    assert not model.needs_rebalance()
+
+
+def test_refused_group_falls_back_to_the_next_nearest(placement):
+    model = placement['model']
+    placement['refused'].add(2)
+
+    group = asyncio.run(incremental.assign_submission(dict(PROFILES[1], email='new@example.com')))
+
+    assert placement['calls'][0] == 2
+    assert group['id'] == placement['calls'][-1] != 2
+    assert model.full == {1}
+    # The refused group is skipped without asking the database again
+    placement['calls'].clear()
+    asyncio.run(incremental.assign_submission(dict(PROFILES[1], email='other@example.com')))
+    assert 2 not in placement['calls']
+
+
+def test_submission_no_group_accepts_requests_a_rebalance(placement):
+    model = placement['model']
+    placement['refused'].update({1, 2, 3})
+
+    group = asyncio.run(incremental.assign_submission(dict(PROFILES[0], email='new@example.com')))
+
+    assert group is None
+    assert sorted(placement['calls']) == [1, 2, 3]
+    assert model.unplaced == 1
+    assert model.needs_rebalance()
+
+
+def test_rebalance_after_drifting_placements(monkeypatch):
+    model = make_model()
+    # Identical answers per group leave no baseline spread, so give it one
+    model.baseline_distance = 1.0
+    model.fitted_members = 100
+    monkeypatch.setattr(incremental, 'REBALANCE_DRIFT_RATIO', 1.5)
+
+    vector = model.encoder.transform([PROFILES[0]]).toarray()[0]
+    model.place(vector, 0, 1.4)
+    assert not model.needs_rebalance()
+    model.place(vector, 0, 2.0)
+    assert model.needs_rebalance()
+
+
+def test_rebalance_after_too_many_new_members(monkeypatch):
+    model = make_model()
+    monkeypatch.setattr(incremental, 'REBALANCE_MAX_NEW_FRACTION', 0.2)
+
+    vector = model.encoder.transform([PROFILES[0]]).toarray()[0]
+    # 12 fitted members allow 2.4 incremental placements
+    for _ in range(2):
+        model.place(vector, 0, 0.0)
+    assert not model.needs_rebalance()
+    model.place(vector, 0, 0.0)
+    assert model.needs_rebalance()
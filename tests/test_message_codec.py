@@ -0,0 +1,45 @@
+import pytest
+from message_codec import MAX_MESSAGE_LENGTH, MAX_PAYLOAD_BYTES, MessageError, decode_frame, loads, new_message
+
+
+def test_decode_frame_stamps_and_encodes_once():
+    message = decode_frame('{"email": "a@example.edu", "message": "hi", "group_name": "other"}', 'group-1')
+
+    assert message.record['group_name'] == 'group-1'
+    assert message.record['email'] == 'a@example.edu'
+    assert message.record['id']
+    payload = loads(message.payload)
+    assert payload['id'] == message.record['id']
+    assert payload['message'] == 'hi'
+    assert payload['timestamp'] == message.record['timestamp'].isoformat()
+
+
+@pytest.mark.parametrize('frame', [
+    'not json',
+    '[1, 2]',
+    '{"email": "a@example.edu"}',
+    '{"email": "", "message": "hi"}',
+    '{"email": "a@example.edu", "message": "   "}',
+    '{"email": 5, "message": "hi"}',
+    '{"email": "a@example.edu", "message": "nul \\u0000 inside"}',
+    '{"email": "a\\u0000@example.edu", "message": "hi"}',
+])
+def test_decode_frame_rejects_invalid_frames(frame):
+    with pytest.raises(MessageError):
+        decode_frame(frame, 'group-1')
+
+
+def test_new_message_bounds_length_in_characters_and_bytes():
+    new_message('group-1', 'a@example.edu', 'x' * MAX_MESSAGE_LENGTH)
+    with pytest.raises(MessageError):
+        new_message('group-1', 'a@example.edu', 'x' * (MAX_MESSAGE_LENGTH + 1))
+    # Within the character limit, but four bytes per character once encoded
+    emoji = '\U0001F600' * (MAX_PAYLOAD_BYTES // 4)
+    assert len(emoji) <= MAX_MESSAGE_LENGTH
+    with pytest.raises(MessageError):
+        new_message('group-1', 'a@example.edu', emoji)
+
+
+def test_new_message_rejects_nul_in_group_name():
+    with pytest.raises(MessageError):
+        new_message('group\x00', 'a@example.edu', 'hi')
@@ -0,0 +1,43 @@
+import asyncio
+from message_writer import MessageWriter
+
+
+def test_message_writer_drops_only_rows_that_fail_for_good():
+    saved = []
+
+    async def save_batch(batch):
+        if any(message['message'] == 'bad' for message in batch):
+            raise ValueError("invalid byte sequence")
+        saved.extend(batch)
+
+    async def run():
+        writer = MessageWriter(save_batch, batch_size=8, flush_interval_ms=10,
+                               is_retryable=lambda error: False)
+        writer.start()
+        for i in range(8):
+            await writer.put({'id': i, 'message': 'bad' if i == 5 else 'ok'})
+        await writer.stop(timeout=5)
+        return writer
+
+    writer = asyncio.run(run())
+
+    assert sorted(message['id'] for message in saved) == [0, 1, 2, 3, 4, 6, 7]
+    assert writer.written == 7
+    assert writer.dropped == 1
+
+
+def test_message_writer_stop_gives_up_after_timeout():
+    async def save_batch(batch):
+        raise ConnectionError("database is down")
+
+    async def run():
+        writer = MessageWriter(save_batch, batch_size=1, flush_interval_ms=1, max_pending=1)
+        writer.start()
+        await writer.put({'id': 1})
+        await writer.put({'id': 2})
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        await writer.stop(timeout=0.2)
+        return loop.time() - started
+
+    assert asyncio.run(run()) < 1
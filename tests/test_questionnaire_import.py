@@ -0,0 +1,66 @@
+import pytest
+from database import QUESTIONNAIRE_COLUMNS
+from questionnaire_import import ImportBatches, ImportRowError, format_from_content_type, read_rows, validate_row
+
+
+def test_validate_row_orders_and_cleans_answers():
+    row = validate_row({'email': ' a@example.edu ', 'hobbies': ['coding', 'reading'], 'gender': '  ', 'extra': 'x'})
+
+    assert len(row) == len(QUESTIONNAIRE_COLUMNS)
+    assert row[0] == 'a@example.edu'
+    values = dict(zip(QUESTIONNAIRE_COLUMNS, row))
+    assert values['hobbies'] == 'coding,reading'
+    assert values['gender'] is None
+
+
+@pytest.mark.parametrize('row', [
+    {'hobbies': 'coding'},
+    {'email': '   '},
+    {'email': 'no-at-sign'},
+    {'email': 'x' * 320 + '@example.edu'},
+    {'email': 'a@example.edu', 'hobbies': [1, 2]},
+    {'email': 'a@example.edu', 'hobbies': {'a': 1}},
+    {'email': 'a@example.edu', 'hobbies': True},
+    ['a@example.edu'],
+])
+def test_validate_row_rejects_invalid_rows(row):
+    with pytest.raises(ImportRowError):
+        validate_row(row)
+
+
+def test_import_batches_skip_and_report_invalid_rows():
+    lines = [
+        '{"email": "a@example.edu"}\n',
+        'not json\n',
+        '\n',
+        '{"email": "missing-at"}\n',
+        '{"email": "b@example.edu"}\n',
+        '{"email": "c@example.edu"}\n',
+    ]
+    batches = ImportBatches(lines, 'ndjson', batch_size=2, max_errors=1)
+
+    result = list(batches)
+
+    assert [[row[:2] for row in batch] for batch in result] == [
+        [(1, 'a@example.edu'), (5, 'b@example.edu')],
+        [(6, 'c@example.edu')],
+    ]
+    assert batches.read == 5
+    assert batches.invalid == 2
+    assert batches.errors == [{'line': 2, 'error': 'line is not valid JSON'}]
+
+
+def test_csv_rows_are_numbered_by_their_last_line():
+    lines = ['email,hobbies\n', 'a@example.edu,"coding,\n', 'reading"\n', 'b@example.edu,\n']
+
+    rows = list(read_rows(lines, 'csv'))
+
+    assert [line for line, _ in rows] == [3, 4]
+    assert rows[0][1]['hobbies'] == 'coding,\nreading'
+
+
+def test_unknown_format_is_rejected():
+    with pytest.raises(ValueError):
+        list(read_rows([], 'xml'))
+    assert format_from_content_type('text/csv; charset=utf-8') == 'csv'
+    assert format_from_content_type('application/json') is None
@@ -0,0 +1,108 @@
+import asyncio
+import pytest
+from read_cache import TTLCache
+
+
+def test_entries_expire_after_ttl(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr('read_cache.time.monotonic', lambda: now[0])
+    cache = TTLCache(maxsize=10, ttl=5)
+    cache.set(('groups',), [1])
+
+    assert cache.get(('groups',)) == [1]
+    now[0] += 6
+    assert cache.get(('groups',), None) is None
+    assert cache.stats()['hits'] == 1 and cache.stats()['misses'] == 1
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set(('a',), 1)
+    cache.set(('b',), 2)
+    cache.get(('a',))
+    cache.set(('c',), 3)
+
+    assert cache.get(('b',), None) is None
+    assert cache.get(('a',)) == 1 and cache.get(('c',)) == 3
+
+
+def test_invalidate_drops_every_key_with_the_prefix():
+    cache = TTLCache(maxsize=10, ttl=60)
+    cache.set(('messages', 'g1'), 1)
+    cache.set(('messages', 'g2'), 2)
+    cache.set(('groups',), 3)
+
+    cache.invalidate('messages')
+
+    assert cache.get(('messages', 'g1'), None) is None
+    assert cache.get(('messages', 'g2'), None) is None
+    assert cache.get(('groups',)) == 3
+
+
+def test_concurrent_misses_share_one_load():
+    calls = []
+
+    async def loader():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return 'value'
+
+    async def run():
+        cache = TTLCache(maxsize=10, ttl=60)
+        results = await asyncio.gather(*[cache.aload(('k',), loader) for _ in range(5)])
+        return results, cache.get(('k',))
+
+    results, cached = asyncio.run(run())
+    assert results == ['value'] * 5
+    assert cached == 'value'
+    assert len(calls) == 1
+
+
+def test_cancelling_the_first_caller_does_not_cancel_the_others():
+    async def loader():
+        await asyncio.sleep(0.05)
+        return 'value'
+
+    async def run():
+        cache = TTLCache(maxsize=10, ttl=60)
+        first = asyncio.create_task(cache.aload(('k',), loader))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(cache.aload(('k',), loader))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second, cache.get(('k',))
+
+    assert asyncio.run(run()) == ('value', 'value')
+
+
+def test_failed_load_is_not_cached_and_reaches_every_caller():
+    async def loader():
+        await asyncio.sleep(0.01)
+        raise RuntimeError("database is down")
+
+    async def run():
+        cache = TTLCache(maxsize=10, ttl=60)
+        results = await asyncio.gather(*[cache.aload(('k',), loader) for _ in range(3)], return_exceptions=True)
+        return results, cache.pending
+
+    results, pending = asyncio.run(run())
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert pending == {}
+
+
+def test_load_finished_after_an_invalidation_is_not_cached():
+    async def run():
+        cache = TTLCache(maxsize=10, ttl=60)
+
+        async def loader():
+            await asyncio.sleep(0.01)
+            return 'stale'
+
+        task = asyncio.create_task(cache.aload(('groups',), loader))
+        await asyncio.sleep(0)
+        cache.invalidate('groups')
+        return await task, cache.get(('groups',), None)
+
+    assert asyncio.run(run()) == ('stale', None)
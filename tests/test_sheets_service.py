@@ -0,0 +1,103 @@
+import asyncio
+import threading
+import pytest
+import sheets_service
+from fake_sheets import FakeSheets
+from sheets_service import SHEETS_MIRROR_REFRESH_INTERVAL, SheetsService, message_row
+
+
+def message(i, group_name='g1'):
+    return {'id': f'id{i}', 'group_name': group_name, 'email': 'a@example.edu',
+            'message': f'message {i}', 'timestamp': f'2024-01-01T00:00:0{i}'}
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(sheets_service.time, 'monotonic', lambda: now[0])
+    return now
+
+
+@pytest.fixture
+def fake(monkeypatch):
+    fake = FakeSheets()
+    fake.ranges = []
+    get = fake.get
+
+    def logged_get(range_name):
+        fake.ranges.append(range_name)
+        return get(range_name)
+    monkeypatch.setattr(fake, 'get', logged_get)
+    return fake
+
+
+def append_rows(fake, *messages):
+    fake.append(sheets_service.MESSAGES_RANGE, [message_row(m) for m in messages])
+
+
+def test_refresh_reads_only_rows_after_the_last_one_consumed(fake, clock):
+    append_rows(fake, message(1), message(2))
+    service = SheetsService(sheet=fake)
+
+    assert [m['id'] for m in service.get_messages('g1')] == ['id1', 'id2']
+    append_rows(fake, message(3))
+    service.refresh_messages(force=True)
+
+    assert fake.requests['get'] == 2
+    # Header plus two messages were consumed, so the second read starts at row 4
+    assert fake.ranges == ['Messages!A1:E', 'Messages!A4:E']
+    assert [m['id'] for m in service.get_messages('g1')] == ['id1', 'id2', 'id3']
+
+
+def test_refresh_runs_at_most_once_per_interval(fake, clock):
+    service = SheetsService(sheet=fake)
+
+    service.get_messages('g1')
+    service.get_messages('g1')
+    assert fake.requests['get'] == 1
+
+    clock[0] += SHEETS_MIRROR_REFRESH_INTERVAL
+    service.get_messages('g1')
+    assert fake.requests['get'] == 2
+
+
+def test_local_messages_are_not_duplicated_when_read_back(fake, clock):
+    service = SheetsService(sheet=fake)
+    service.save_message(message(1))
+    service.messages.add(message(2))
+    append_rows(fake, message(2))
+
+    service.refresh_messages(force=True)
+
+    assert [m['id'] for m in service.get_messages('g1')] == ['id1', 'id2']
+    assert service.messages.rows_read == 3
+
+
+def test_get_messages_after(fake, clock):
+    append_rows(fake, *[message(i) for i in range(1, 6)], message(9, 'g2'))
+    service = SheetsService(sheet=fake)
+
+    after = service.get_messages_after('g1', 'id2', 10)
+    assert [m['id'] for m in after] == ['id3', 'id4', 'id5']
+    assert [m['id'] for m in service.get_messages_after('g1', 'id1', 2)] == ['id4', 'id5']
+    assert service.get_messages_after('g1', 'id5', 10) == []
+    assert service.get_messages_after('g1', 'id9', 10) is None
+    assert service.get_messages_after('g1', 'unknown', 10) is None
+
+
+def test_async_history_reads_the_sheet_off_the_event_loop(fake, clock, monkeypatch):
+    append_rows(fake, message(1), message(2))
+    service = SheetsService(sheet=fake)
+    threads = []
+    get = fake.get
+    monkeypatch.setattr(fake, 'get', lambda range_name: (threads.append(threading.get_ident()), get(range_name))[1])
+
+    async def run():
+        return await asyncio.gather(*[service.aget_messages_after('g1', 'id1', 10) for _ in range(3)])
+
+    results = asyncio.run(run())
+
+    assert [[m['id'] for m in result] for result in results] == [['id2']] * 3
+    # Concurrent callers wait for the one refresh instead of starting their own
+    assert fake.requests['get'] == 1
+    assert threads and threading.get_ident() not in threads
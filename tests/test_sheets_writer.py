@@ -0,0 +1,95 @@
+import asyncio
+import json
+from sheets_writer import SHEETS_SPOOL_PATH, SheetsWriter, SpoolJournal
+
+
+def journal_lines(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_unacknowledged_rows_are_replayed(tmp_path):
+    path = str(tmp_path / 'spool.ndjson')
+
+    async def write():
+        journal = SpoolJournal(path, fsync=False)
+        journal.open()
+        for i in range(5):
+            await journal.append({'range': 'Messages!A:E', 'values': [i]})
+        await journal.ack(2)
+        journal.close()
+
+    asyncio.run(write())
+    journal = SpoolJournal(path, fsync=False)
+    replayed = journal.open()
+    journal.close()
+
+    assert [entry['values'] for entry in replayed] == [[2], [3], [4]]
+    assert [entry['seq'] for entry in replayed] == [3, 4, 5]
+    # Compacted to the rows still pending
+    assert len(journal_lines(path)) == 3
+
+
+def test_journal_is_truncated_once_everything_is_acknowledged(tmp_path):
+    path = str(tmp_path / 'spool.ndjson')
+
+    async def write():
+        journal = SpoolJournal(path, fsync=False)
+        journal.open()
+        seqs = [await journal.append({'range': 'Messages!A:E', 'values': [i]}) for i in range(3)]
+        await journal.ack(seqs[-1])
+        journal.close()
+
+    asyncio.run(write())
+    assert journal_lines(path) == []
+
+
+def test_torn_last_line_is_ignored(tmp_path):
+    path = tmp_path / 'spool.ndjson'
+    path.write_text('{"range": "A", "values": [1], "seq": 1}\n{"range": "A", "val')
+
+    journal = SpoolJournal(str(path), fsync=False)
+    replayed = journal.open()
+    journal.close()
+
+    assert [entry['seq'] for entry in replayed] == [1]
+    # New rows continue after the replayed ones
+    assert journal.seq == 1
+
+
+def test_concurrent_appends_share_a_write(tmp_path, monkeypatch):
+    path = str(tmp_path / 'spool.ndjson')
+    writes = []
+
+    async def run():
+        journal = SpoolJournal(path, fsync=True)
+        journal.open()
+        write_lines = journal._write_lines
+        monkeypatch.setattr(journal, '_write_lines', lambda lines: (writes.append(len(lines)), write_lines(lines)))
+        seqs = await asyncio.gather(*[journal.append({'range': 'A', 'values': [i]}) for i in range(50)])
+        journal.close()
+        return seqs
+
+    seqs = asyncio.run(run())
+    assert seqs == list(range(1, 51))
+    assert sum(writes) == 50 and len(writes) < 50
+    assert [line['seq'] for line in journal_lines(path)] == seqs
+
+
+def test_writer_journals_by_default_and_warns_when_disabled(tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+
+    async def run(**kwargs):
+        writer = SheetsWriter(lambda: None, 'sheet', **kwargs)
+        await writer.start()
+        await writer.put('Messages!A:E', ['row'])
+        journaled = writer.journal is not None
+        await writer.stop(timeout=0)
+        return journaled
+
+    assert asyncio.run(run())
+    assert (tmp_path / SHEETS_SPOOL_PATH).exists()
+    assert 'WARNING' not in capsys.readouterr().out
+
+    assert not asyncio.run(run(spool_path=''))
+    assert 'WARNING: SHEETS_SPOOL_PATH is empty' in capsys.readouterr().out
@@ -0,0 +1,54 @@
+import numpy as np
+
+from datasets import synthetic_questionnaires
+from features import FeatureEncoder
+from suggestions import SuggestionIndex
+
+
+def questionnaires(n_users, seed=1):
+    rows = synthetic_questionnaires(n_users, seed).to_dict('records')
+    encoder = FeatureEncoder()
+    return encoder, encoder.fit_transform(rows), rows
+
+
+def test_added_users_match_a_full_rebuild():
+    encoder, features, rows = questionnaires(600)
+    emails = [row['email'] for row in rows]
+    index = SuggestionIndex.build(encoder, features[:500], emails[:500])
+    for row in rows[500:]:
+        index.add(row)
+
+    rebuilt = SuggestionIndex.build(encoder, features, emails)
+
+    n = len(rows)
+    assert index.emails == emails
+    np.testing.assert_array_equal(index.neighbours[:n], rebuilt.neighbours)
+    np.testing.assert_allclose(index.scores[:n], rebuilt.scores, rtol=1e-6)
+    assert index.suggest(emails[-1]) == rebuilt.suggest(emails[-1])
+
+
+def test_edited_user_replaces_its_old_row():
+    encoder, features, rows = questionnaires(200)
+    index = SuggestionIndex.build(encoder, features, [row['email'] for row in rows])
+    old_row = index.rows[rows[0]['email']]
+
+    index.add(dict(rows[1], email=rows[0]['email']))
+
+    assert not index.active[old_row]
+    assert index.rows[rows[0]['email']] == 200
+    # The edited answers equal user 1's, so user 1 is now its best match
+    assert index.suggest(rows[0]['email'], k=1) == [{'email': rows[1]['email'], 'score': 1.0}]
+
+
+def test_partitioned_build_stays_close_to_exact():
+    encoder, features, rows = questionnaires(3000)
+    emails = [row['email'] for row in rows]
+    exact = SuggestionIndex.build(encoder, features, emails)
+    partitioned = SuggestionIndex.build(encoder, features, emails, exact_max_users=0, partition_size=300)
+
+    # Partitions trade a few neighbours for a linear build: most of the exact
+    # similarity is found, but a third or more of the users miss some of their k.
+    assert partitioned.scores.sum() / exact.scores.sum() >= 0.97
+    assert np.isclose(partitioned.scores[:, 0], exact.scores[:, 0]).mean() >= 0.85
+    assert np.isclose(partitioned.scores[:, -1], exact.scores[:, -1]).mean() >= 0.55
+    assert (partitioned.scores <= exact.scores + 1e-6).all()